@@ -2,9 +2,13 @@ from http import HTTPStatus
 import json
 import os
 import dotenv
-import requests
 
 from .db import Database
+from .replication import ReplicationError, Replicator
+from libs.compaction import POLICIES
+from libs.compression import get_codec
+from libs.metrics import CONTENT_TYPE, Registry
+from libs.types import Record
 from libs.singleton import Singleton
 
 
@@ -13,53 +17,88 @@ class API(object):
 
     def __init__(self):
         dotenv.load_dotenv()
+        compaction_policy = os.getenv('COMPACTION_POLICY', 'size_tiered')
+        compaction_rate = os.getenv('COMPACTION_BYTES_PER_SECOND')
+        compression_level = os.getenv('COMPRESSION_LEVEL')
+        blob_threshold = os.getenv('BLOB_THRESHOLD')
+        self.metrics = Registry()
         self.database = Database(
             os.getenv('SEGMENT_BASENAME', 'segment-1'),
             os.getenv('SEGMENTS_DIRECTORY', './'),
-            os.getenv('WAL_BASENAME', 'memtable_bk')
+            os.getenv('WAL_BASENAME', 'memtable_bk'),
+            response_cache_bytes=int(os.getenv('RESPONSE_CACHE_BYTES', str(4 * 1024 * 1024))),
+            metrics=self.metrics,
+            block_cache_bytes=int(os.getenv('BLOCK_CACHE_BYTES', str(8 * 1024 * 1024))),
+            compression=get_codec(os.getenv('COMPRESSION', 'none'), int(compression_level) if compression_level else None),
+            blob_threshold=int(blob_threshold) if blob_threshold else None,
+            blob_gc_ratio=float(os.getenv('BLOB_GC_RATIO', '0.5')),
+            wal_durability=os.getenv('WAL_DURABILITY', 'batch'),
+            wal_sync_interval=float(os.getenv('WAL_SYNC_INTERVAL', '0.05')),
+            max_immutable_memtables=int(os.getenv('MAX_IMMUTABLE_MEMTABLES', '2')),
+            compaction_policy=POLICIES[compaction_policy]() if compaction_policy in POLICIES else None,
+            max_concurrent_compactions=int(os.getenv('MAX_CONCURRENT_COMPACTIONS', '1')),
+            compaction_bytes_per_second=int(compaction_rate) if compaction_rate else None,
+            filter_rebuild_workers=int(os.getenv('FILTER_REBUILD_WORKERS', '4'))
+        )
+        self.replicator = Replicator(
+            ack=os.getenv('REPLICATION_ACK', 'async'),
+            batch_size=int(os.getenv('REPLICATION_BATCH_SIZE', '256')),
+            max_pending=int(os.getenv('REPLICATION_MAX_PENDING', '100000')),
+            timeout=float(os.getenv('REPLICATION_TIMEOUT', '5')),
+            retry_backoff=float(os.getenv('REPLICATION_RETRY_BACKOFF', '0.05')),
+            max_backoff=float(os.getenv('REPLICATION_MAX_BACKOFF', '5')),
+            max_failures=int(os.getenv('REPLICATION_MAX_FAILURES', '10')),
+            database=self.database,
+            metrics=self.metrics
         )
-        self.replicas = [None]
         self.current_replica_index = 0
         self.master_mode = os.getenv('DB_NODE_MODE') == 'master'
         self.in_cluster = False
+        self.scan_page_size = int(os.getenv('SCAN_PAGE_SIZE', '100'))
+        self.max_scan_page_size = int(os.getenv('MAX_SCAN_PAGE_SIZE', '1000'))
 
     def process_request(self, method, fn_arg):
         match method := method.path[1:]:
             case 'join':
                 if not self.in_cluster:
-                    print(f'I am node "{fn_arg["id"]}" in charge of keys "{fn_arg["start"]}" to "{fn_arg["end"]}"!')
+                    print(f'I am node "{fn_arg["id"]}" in charge of {len(fn_arg["ranges"])} key ranges, from "{fn_arg["ranges"][0][0]}" to "{fn_arg["ranges"][-1][1]}"!')
                     self.in_cluster = True
                     return ('Alright', HTTPStatus.OK)
                 else:
                     return ('I am already in a cluster', HTTPStatus.CONFLICT)
             case 'ping':
                 return ('PONG', HTTPStatus.OK)
+            case 'metrics':
+                return self.metrics.expose(), HTTPStatus.OK, CONTENT_TYPE
             case 'subscribe': #  Asked to be added as a slave
                 if self.master_mode:
-                    self.replicas.append(f"{fn_arg['ip']}:{fn_arg['port']}")
+                    self.replicator.add(f"{fn_arg['ip']}:{fn_arg['port']}")
                     return 'Subscribed', HTTPStatus.OK
                 else:
                     return 'I am not a master', HTTPStatus.IM_A_TEAPOT
             case 'query':
                 if self.master_mode:
-                    # not the best solution but should help
-                    if self.current_replica_index == 0 or len(self.replicas) == 1:
-                        self.current_replica_index = (self.current_replica_index + 1) % len(self.replicas)
+                    # not the best solution but should help, reads go round the master and the replicas in sync
+                    replicas = [None] + self.replicator.live_replicas()
+                    n = self.current_replica_index % len(replicas)
+                    self.current_replica_index = n + 1
+                    if replicas[n] is None:
                         return self.query(fn_arg)
-                    else:
-                        n = self.current_replica_index
-                        self.current_replica_index = (self.current_replica_index + 1) % len(self.replicas)
-                        return (str(self.replicas[n]), HTTPStatus.TEMPORARY_REDIRECT)
+                    return (str(replicas[n]), HTTPStatus.TEMPORARY_REDIRECT)
                 else:
                     return self.query(fn_arg)
+            case 'mquery':
+                return self.multi_query(fn_arg)
+            case 'scan':
+                return self.scan(fn_arg)
             case 'set':
-                result = self.set(fn_arg)
-                with requests.Session() as r:
-                    for replica in self.replicas[1:]:
-                        res = r.put(f'http://{ replica }/set', data=fn_arg)
-                        if res.ok:
-                            print(f'Replica { replica } synced!')
-                return result
+                return self.replicated_write('set', fn_arg, self.set)
+            case 'delete':
+                return self.replicated_write('delete', fn_arg, self.delete)
+            case 'mset':  # a batch of replicated writes
+                if self.master_mode:
+                    return 'I am a master, write with set and delete', HTTPStatus.CONFLICT
+                return self.write_batch(fn_arg)
             case _:
                 return (f'Action "{method}" does not exist!',  HTTPStatus.BAD_REQUEST)
 
@@ -70,10 +109,72 @@ class API(object):
         statusCode = HTTPStatus.OK if value else HTTPStatus.NOT_FOUND
         return value, statusCode
 
+    def multi_query(self, data=None):
+        # a json list of hex keys, answered with an object holding only the keys that were found
+        keys = [bytes.fromhex(key) for key in data]
+        values = self.database.multi_get(keys)
+        return json.dumps({
+            key.hex(): value.to_json() for key, value in values.items()
+        }), HTTPStatus.OK
+
+    def scan(self, data=None):
+        # one page of keys in [start, end), `next` is where the following page starts
+        data = data if isinstance(data, dict) else {}
+        try:
+            start = bytes.fromhex(data['start']) if data.get('start') else None
+            end = bytes.fromhex(data['end']) if data.get('end') else None
+            limit = int(data.get('limit', self.scan_page_size))
+        except (TypeError, ValueError) as e:
+            return f'Malformed scan: {e}', HTTPStatus.BAD_REQUEST
+        # an empty page would hand back its own start as the next one
+        if limit < 1:
+            return 'The limit must be at least 1', HTTPStatus.BAD_REQUEST
+        limit = min(limit, self.max_scan_page_size)
+
+        items = []
+        next_key = None
+        for key, value in self.database.scan(start, end, limit + 1):
+            if len(items) == limit:
+                next_key = key.hex()
+                break
+            items.append({'key': key.hex(), **value.to_json()})
+        return json.dumps({'items': items, 'next': next_key}), HTTPStatus.OK
+
+    def replicated_write(self, operation, data, apply):
+        # replicas get the write in the background, it is acknowledged once enough of them applied it
+        with self.replicator.key_lock(data['key']):
+            if not self.replicator.has_room():
+                return 'The replicas are too far behind, try again later', HTTPStatus.SERVICE_UNAVAILABLE
+            result = apply(data)
+            if result[1] != HTTPStatus.OK:
+                return result
+            tickets = self.replicator.append({**data, 'op': operation})
+        try:
+            acknowledged = self.replicator.wait(tickets)
+        except ReplicationError as e:
+            return f'Written, but not acknowledged by the replicas: {e}', HTTPStatus.BAD_GATEWAY
+        if not acknowledged:
+            return f'Written, but not acknowledged by the replicas within {self.replicator.timeout}s', HTTPStatus.GATEWAY_TIMEOUT
+        return result
+
+    def write_batch(self, data=None):
+        try:
+            items = [
+                (bytes.fromhex(write['key']), None if write['op'] == 'delete' else Record.from_json(write))
+                for write in data
+            ]
+        except (KeyError, TypeError, ValueError) as e:
+            return f'Malformed batch: {e}', HTTPStatus.BAD_REQUEST
+        result = self.database.write_batch(items)
+        statusCode = HTTPStatus.INTERNAL_SERVER_ERROR if not result else HTTPStatus.OK
+        return result, statusCode
+
     def set(self, data=None):
-        value = data
-        value['value'] = bytes.fromhex(value['value'])
-        key = value.pop('key', None)
-        result = self.database.set(bytes.fromhex(key), value)
+        result = self.database.set(bytes.fromhex(data['key']), Record.from_json(data))
+        statusCode = HTTPStatus.BAD_REQUEST if not result else HTTPStatus.OK
+        return result, statusCode
+
+    def delete(self, data=None):
+        result = self.database.delete(bytes.fromhex(data['key']))
         statusCode = HTTPStatus.BAD_REQUEST if not result else HTTPStatus.OK
         return result, statusCode
\ No newline at end of file
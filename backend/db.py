@@ -1,25 +1,110 @@
-from typing import Dict, Optional
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+from libs.block_cache import BlockCache
 from libs.lsm_tree import LSMTree
-from libs.types import Value
+from libs.metrics import Registry
+from libs.types import TOMBSTONE, Value
+
+
+# rough cost of a cached response on top of its bytes
+RESPONSE_OVERHEAD = 100
 
 
 class Database(object):
     
-    def __init__(self, segment_basename: str, segments_directory: str, wal_basename: str) -> None:
-        self.db: LSMTree = LSMTree(segment_basename, segments_directory, wal_basename)
-    
-    def get(self, key: bytes) -> Optional[str]:
+    def __init__(
+        self,
+        segment_basename: str,
+        segments_directory: str,
+        wal_basename: str,
+        response_cache_bytes: int = 4 * 1024 * 1024,
+        metrics: Optional[Registry] = None,
+        **options
+    ) -> None:
+        self.metrics: Registry = metrics if metrics is not None else Registry()
+        self.db: LSMTree = LSMTree(segment_basename, segments_directory, wal_basename, metrics=self.metrics, **options)
+        # encoded query responses of hot keys, ready to be written to the socket, 0 disables it
+        self.responses: Optional[BlockCache] = BlockCache(response_cache_bytes) if response_cache_bytes else None
+        # a read that overlapped a write may have seen the old value, it is not cached
+        self.writes: int = 0
+        self.writes_lock: Lock = Lock()
+
+        help = 'Time spent in the storage engine, cached responses included'
+        self.get_seconds = self.metrics.histogram('kvdb_db_operation_seconds', help, operation='get')
+        self.multi_get_seconds = self.metrics.histogram('kvdb_db_operation_seconds', help, operation='multi_get')
+        self.set_seconds = self.metrics.histogram('kvdb_db_operation_seconds', help, operation='set')
+        self.delete_seconds = self.metrics.histogram('kvdb_db_operation_seconds', help, operation='delete')
+        self.write_batch_seconds = self.metrics.histogram('kvdb_db_operation_seconds', help, operation='write_batch')
+        if self.responses is not None:
+            self.metrics.counter('kvdb_cache_hits_total', 'Cache hits', lambda: self.responses.hits, cache='response')
+            self.metrics.counter('kvdb_cache_misses_total', 'Cache misses', lambda: self.responses.misses, cache='response')
+            self.metrics.gauge('kvdb_cache_bytes', 'Bytes held by the cache', lambda: self.responses.used_bytes, cache='response')
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        with self.get_seconds.time():
+            return self.cached_get(key)
+
+    def cached_get(self, key: bytes) -> Optional[bytes]:
+        if self.responses is not None:
+            response = self.responses.get(key)
+            if response is not None:
+                return response
+        writes = self.writes
         val = self.db.db_get(key)
-        return self.db.serialize_value(val) if val else val
+        if not val:
+            return None
+        response = self.db.serialize_value(val).encode()
+        if self.responses is not None:
+            with self.writes_lock:
+                if self.writes == writes:
+                    self.responses.put(key, response, len(response) + RESPONSE_OVERHEAD)
+        return response
     
+    def multi_get(self, keys: Iterable[bytes]) -> Dict[bytes, Value]:
+        with self.multi_get_seconds.time():
+            return self.db.multi_get(keys)
+
+    def scan(self, start: Optional[bytes], end: Optional[bytes], limit: int) -> Iterator[Tuple[bytes, Value]]:
+        return self.db.scan(start, end, limit)
+
+    def invalidate(self, key: bytes) -> None:
+        if self.responses is not None:
+            with self.writes_lock:
+                self.writes += 1
+                self.responses.invalidate(key)
+
     def set(self, key: bytes, value: Value) -> None:
         try:
-            self.db.db_set(key, value)
+            with self.set_seconds.time():
+                self.db.db_set(key, value)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+        finally:
+            self.invalidate(key)
+
+    def delete(self, key: bytes) -> bool:
+        try:
+            with self.delete_seconds.time():
+                self.db.db_delete(key)
             return True
         except Exception as e:
             print(e)
             return False
-        
-        
+        finally:
+            self.invalidate(key)
 
+    def write_batch(self, items: List[Tuple[bytes, Optional[Value]]]) -> bool:
+        # writes applied in order, a None value deletes its key
+        try:
+            with self.write_batch_seconds.time():
+                self.db.db_write_batch([(key, TOMBSTONE if value is None else value) for key, value in items])
+            return True
+        except Exception as e:
+            print(e)
+            return False
+        finally:
+            for key, _ in items:
+                self.invalidate(key)
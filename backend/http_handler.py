@@ -1,8 +1,8 @@
 from enum import Enum
-from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse
 import json
 
+from libs.http_server import BoundedRequestHandler
 from .api import API
 
 
@@ -12,17 +12,27 @@ class HTTPMethod(Enum):
     PUT = 3
 
 
-class HTTPHandler(BaseHTTPRequestHandler):
+class HTTPHandler(BoundedRequestHandler):
 
-    def __send_response(self, result, status_code) -> None:
+    # connections are kept alive, an idle one is closed after `timeout` seconds to free its thread
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+    # headers and body are separate writes, without this the second one waits on the delayed ack of the first
+    disable_nagle_algorithm = True
+
+    def __send_response(self, result, status_code, content_type='application/json') -> None:
+        # cached responses are already encoded
+        body = result if isinstance(result, bytes) else str(result).encode()
         self.send_response(status_code)
-        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(str(result).encode())
+        self.wfile.write(body)
 
     def do_GET(self) -> None:
-        result, status_code = API.instance().process_request(urlparse(self.path), fn_arg=None)
-        return self.__send_response(result, status_code)
+        return self.__send_response(
+            *API.instance().process_request(urlparse(self.path), fn_arg=None)
+        )
 
     def do_POST(self) -> None:
         return self.__send_response(
@@ -42,5 +52,4 @@ class HTTPHandler(BaseHTTPRequestHandler):
         except:
             content = content_
         finally:
-            result, status_code = API.instance().process_request(urlparse(self.path), fn_arg=content)
-            return result, status_code
+            return API.instance().process_request(urlparse(self.path), fn_arg=content)
@@ -0,0 +1,251 @@
+from collections import deque
+from http import HTTPStatus
+from itertools import count, islice
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+import requests
+
+from libs.metrics import Registry
+
+
+ACK_MODES = ('async', 'one', 'all')
+
+# {"op": "set" | "delete", "key": ..., and the record fields of a set}
+Write = Dict[str, Any]
+Ticket = Tuple['ReplicaQueue', int]
+
+
+class ReplicationError(Exception):
+    '''A replica refused writes or was dropped, they will never be acknowledged.'''
+
+
+class ReplicaQueue(object):
+    '''Writes waiting for one replica, a background thread ships them in order, many per request.
+
+    A new queue first copies the whole database to the replica, then ships the writes queued meanwhile.
+    A replica that rejects writes or fails `max_failures` times in a row is evicted: its queue is dropped
+    and its writers are told, until it subscribes again and is copied anew.
+    '''
+
+    def __init__(self, replica: str, replicator: 'Replicator') -> None:
+        self.replica: str = replica
+        self.replicator: 'Replicator' = replicator
+        # guarded by the condition of the replicator, which also wakes the writers waiting for acks
+        self.pending: Deque[Write] = deque()
+        self.appended: int = 0  # sequence number of the last queued write
+        self.shipped: int = 0  # the replica applied every write up to this one
+        self.syncing: bool = replicator.database is not None  # still copying the database, it neither acks nor serves reads
+        self.failure: Optional[str] = None  # why it was evicted
+
+        # shared by the queues a replica gets every time it subscribes
+        metrics = replicator.metrics
+        self.ship_seconds = metrics.histogram('kvdb_replication_seconds', 'Time for a replica to apply a batch of writes', replica=replica)
+        self.errors = metrics.counter('kvdb_replication_errors_total', 'Batches a replica failed to apply', replica=replica)
+        self.writes = metrics.counter('kvdb_replication_writes_total', 'Writes applied by a replica', replica=replica)
+        self.pending_writes = metrics.gauge('kvdb_replication_pending_writes', 'Writes waiting to be shipped to a replica', replica=replica)
+        self.evictions = metrics.counter('kvdb_replication_evictions_total', 'Times a replica was dropped', replica=replica)
+
+        self.thread: Thread = Thread(target=self.ship_forever, name=f'replication-{replica}', daemon=True)
+        self.thread.start()
+
+    def append(self, write: Write) -> int:
+        # called with the condition held
+        self.pending.append(write)
+        self.appended += 1
+        self.pending_writes.set(len(self.pending))
+        if self.syncing and len(self.pending) >= self.replicator.max_pending:
+            self.evict(f'{len(self.pending)} writes queued while it was being copied')
+        self.replicator.condition.notify_all()
+        return self.appended
+
+    def evict(self, failure: str) -> None:
+        with self.replicator.condition:
+            if self.failure is not None:
+                return
+            print(f'Replica {self.replica} was evicted! reason="{failure}"')
+            self.failure = failure
+            self.pending.clear()
+            self.pending_writes.set(0)
+            self.evictions.inc()
+            self.replicator.condition.notify_all()
+
+    def ship_forever(self) -> None:
+        condition = self.replicator.condition
+        with requests.Session() as session:
+            if self.syncing:
+                if not self.retry(lambda: self.copy(session)):
+                    return
+                with condition:
+                    self.syncing = False
+            while True:
+                with condition:
+                    while not self.pending and self.failure is None:
+                        condition.wait()
+                    if self.failure is not None:
+                        return
+                    # stays queued until the replica applied it, so a failed batch is sent again as it was
+                    batch = list(islice(self.pending, self.replicator.batch_size))
+
+                if not self.retry(lambda: self.ship(session, batch)):
+                    return
+                with condition:
+                    for _ in batch:
+                        self.pending.popleft()
+                    self.shipped += len(batch)
+                    self.pending_writes.set(len(self.pending))
+                    condition.notify_all()
+                self.writes.inc(len(batch))
+
+    def retry(self, attempt: Callable[[], None]) -> bool:
+        # False once the replica was evicted, failed attempts are retried after a backoff that doubles
+        backoff = self.replicator.retry_backoff
+        for failures in count(1):
+            if self.failure is not None:
+                return False
+            try:
+                attempt()
+                return True
+            except ReplicationError as e:
+                self.errors.inc()
+                self.evict(str(e))
+                return False
+            except (requests.RequestException, ValueError) as e:
+                print(e)
+                self.errors.inc()
+                if failures >= self.replicator.max_failures:
+                    self.evict(f'{failures} failed attempts in a row, the last one: {e}')
+                    return False
+                sleep(backoff)
+                backoff = min(backoff * 2, self.replicator.max_backoff)
+        return False
+
+    def request(self, session: requests.Session, method: str, action: str, json: Any) -> requests.Response:
+        res = session.request(method, f'http://{self.replica}/{action}', json=json, timeout=self.replicator.timeout)
+        if res.status_code >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            raise requests.HTTPError(f'Replica {self.replica} failed to {action}! message="{res.text}"')
+        if not res.ok:
+            # the replica refused the request itself, sending it again would not help
+            raise ReplicationError(f'Replica {self.replica} refused to {action} with status {res.status_code}! message="{res.text}"')
+        return res
+
+    def ship(self, session: requests.Session, batch: List[Write]) -> None:
+        with self.ship_seconds.time():
+            self.request(session, 'PUT', 'mset', batch)
+
+    def copy(self, session: requests.Session) -> None:
+        # keys the replica holds but the database does not are deleted, then every key of the database is written,
+        # the writes queued since this queue was made are shipped after it, so the newest value of every key wins
+        database = self.replicator.database
+        batch_size = self.replicator.batch_size
+        start = None
+        while True:
+            page = self.request(session, 'POST', 'scan', {'start': start, 'limit': batch_size}).json()
+            keys = [bytes.fromhex(item['key']) for item in page['items']]
+            found = database.multi_get(keys)
+            stale = [{'op': 'delete', 'key': key.hex()} for key in keys if key not in found]
+            if stale:
+                self.ship(session, stale)
+            if page['next'] is None:
+                break
+            start = page['next']
+
+        batch = []
+        for key, value in database.scan(None, None, None):
+            batch.append({'op': 'set', 'key': key.hex(), **value.to_json()})
+            if len(batch) == batch_size:
+                self.ship(session, batch)
+                batch = []
+        if batch:
+            self.ship(session, batch)
+
+
+class Replicator(object):
+    '''Ships the writes of a master to its replicas in the background, writers wait for as many acks as `ack` asks.'''
+
+    def __init__(
+        self,
+        ack: str = 'async',
+        batch_size: int = 256,
+        max_pending: int = 100000,
+        timeout: float = 5.0,
+        retry_backoff: float = 0.05,
+        max_backoff: float = 5.0,
+        max_failures: int = 10,
+        database=None,
+        metrics: Optional[Registry] = None,
+        ordering_locks: int = 64
+    ) -> None:
+        if ack not in ACK_MODES:
+            raise ValueError(f'Replication ack must be one of {ACK_MODES}, got "{ack}"')
+        self.ack: str = ack
+        self.batch_size: int = batch_size
+        self.max_pending: int = max_pending
+        self.timeout: float = timeout  # for a replica to answer and for a writer to get its acks, in seconds
+        self.retry_backoff: float = retry_backoff
+        self.max_backoff: float = max_backoff
+        self.max_failures: int = max_failures  # failed attempts in a row before a replica is evicted
+        self.database = database  # copied to every replica that subscribes
+        self.metrics: Registry = metrics if metrics is not None else Registry()
+        self.ack_timeouts = self.metrics.counter('kvdb_replication_ack_timeouts_total', 'Writes not acknowledged by enough replicas in time')
+        self.rejected = self.metrics.counter('kvdb_replication_rejected_writes_total', 'Writes refused because a replica was too far behind')
+
+        self.condition: Condition = Condition()
+        self.queues: Dict[str, ReplicaQueue] = {}
+        # writes to a key are applied and queued under its lock, so replicas see them in the order the master did
+        self.ordering_locks: List[Lock] = [Lock() for _ in range(ordering_locks)]
+
+    def add(self, replica: str) -> None:
+        # a restarted replica keeps its queue and gets the writes it missed, an evicted one is copied again
+        with self.condition:
+            queue = self.queues.get(replica)
+            if queue is None or queue.failure is not None:
+                self.queues[replica] = ReplicaQueue(replica, self)
+
+    def live_replicas(self) -> List[str]:
+        # the replicas holding every write but the latest ones, which can serve reads
+        with self.condition:
+            return [queue.replica for queue in self.queues.values() if queue.failure is None and not queue.syncing]
+
+    def key_lock(self, key: str) -> Lock:
+        return self.ordering_locks[hash(key) % len(self.ordering_locks)]
+
+    def has_room(self) -> bool:
+        # a live replica is never skipped, so writes are refused while one is max_pending writes behind,
+        # an evicted one no longer counts and one being copied is evicted instead
+        with self.condition:
+            if all(len(queue.pending) < self.max_pending for queue in self.queues.values() if queue.failure is None and not queue.syncing):
+                return True
+        self.rejected.inc()
+        return False
+
+    def append(self, write: Write) -> List[Ticket]:
+        # replicas being copied get the write too, but are not waited for
+        tickets = []
+        with self.condition:
+            for queue in list(self.queues.values()):
+                if queue.failure is None:
+                    ticket = (queue, queue.append(write))
+                    if not queue.syncing:
+                        tickets.append(ticket)
+        return tickets
+
+    def wait(self, tickets: List[Ticket]) -> bool:
+        # True once enough replicas applied the write, False when they did not within the timeout,
+        # raises ReplicationError once too many of them were evicted before applying it
+        needed = {'async': 0, 'one': min(1, len(tickets)), 'all': len(tickets)}[self.ack]
+        if not needed:
+            return True
+        deadline = monotonic() + self.timeout
+        with self.condition:
+            while sum(1 for queue, ticket in tickets if queue.shipped >= ticket) < needed:
+                lost = [queue for queue, ticket in tickets if queue.failure is not None and queue.shipped < ticket]
+                if len(tickets) - len(lost) < needed:
+                    raise ReplicationError('; '.join(f'Replica {queue.replica} was evicted: {queue.failure}' for queue in lost))
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.ack_timeouts.inc()
+                    return False
+                self.condition.wait(remaining)
+        return True
@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.red_black_tree import RedBlackTree
+from libs.sstable import SSTableReader, SSTableWriter
+from libs.types import Record
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Memory used per key by the memtable and the segment index')
+    parser.add_argument('-n', '--keys', help='Number of keys to insert', type=int, default=100000)
+    parser.add_argument('-s', '--value-size', help='Size of every value in bytes', type=int, default=100)
+    parser.add_argument('-b', '--block-size', help='Segment block size in bytes', type=int, default=4096)
+    return parser.parse_args()
+
+
+def measure(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return result, used
+
+
+def memtable_bytes(keys, value_size):
+    # keys and values are built up front so only the tree itself is measured
+    values = [Record('application/json', 'utf8', os.urandom(value_size)) for _ in keys]
+
+    def build():
+        memtable = RedBlackTree()
+        for key, value in zip(keys, values):
+            memtable.add(key, value)
+        return memtable
+    return measure(build)
+
+
+def index_bytes(keys, value_size, block_size):
+    path = os.path.join(tempfile.mkdtemp(), 'segment')
+    with SSTableWriter(path, block_size) as writer:
+        for key in sorted(keys):
+            writer.add(key, Record('application/json', 'utf8', os.urandom(value_size)))
+
+    def build():
+        reader = SSTableReader(path)
+        reader.load()
+        return reader
+    return measure(build)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    keys = [os.urandom(16) for _ in range(args.keys)]
+
+    memtable, used = memtable_bytes(keys, args.value_size)
+    print(f'memtable: {args.keys} keys, {used / args.keys:.1f} bytes per key on top of keys and values')
+
+    reader, used = index_bytes(keys, args.value_size, args.block_size)
+    blocks = len(reader.offsets)
+    print(f'segment index and filter: {blocks} blocks, {used / blocks:.1f} bytes per block, {used / args.keys:.2f} bytes per key')
@@ -0,0 +1,328 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mmh3 import hash64, hash_bytes
+
+from backend.db import Database
+from libs.compaction import POLICIES
+from libs.compression import get_codec
+from libs.lsm_tree import LSMTree
+from libs.types import Record
+
+
+# Operation mixes of the YCSB core workloads, plus a write only one
+WORKLOADS = {
+    'a': {'read': 0.5, 'update': 0.5},
+    'b': {'read': 0.95, 'update': 0.05},
+    'c': {'read': 1.0},
+    'd': {'read': 0.95, 'insert': 0.05},
+    'e': {'scan': 0.95, 'insert': 0.05},
+    'w': {'update': 1.0}
+}
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='YCSB style benchmark of the storage engine')
+    parser.add_argument('-w', '--workload', help='Operation mix of the run phase', choices=WORKLOADS, default='a')
+    parser.add_argument('-t', '--target', help='Drive the LSMTree directly or through the backend Database', choices=('lsm', 'database'), default='lsm')
+    parser.add_argument('-r', '--records', help='Keys inserted by the load phase', type=int, default=100000)
+    parser.add_argument('-o', '--operations', help='Operations of the run phase', type=int, default=100000)
+    parser.add_argument('-d', '--distribution', help='Key popularity of the run phase', choices=('uniform', 'zipfian'), default='zipfian')
+    parser.add_argument('--zipfian-constant', type=float, default=0.99)
+    parser.add_argument('--value-size', help='Largest value size in bytes', type=int, default=100)
+    parser.add_argument('--min-value-size', help='Smallest value size when sizes are uniform', type=int, default=1)
+    parser.add_argument('--value-size-distribution', choices=('constant', 'uniform'), default='constant')
+    parser.add_argument('--value-kind', help='Random bytes or compressible text', choices=('random', 'text'), default='text')
+    parser.add_argument('--scan-length', help='Largest number of keys per scan', type=int, default=100)
+    parser.add_argument('--compaction', help='Background policy, a single full compaction or none', choices=tuple(POLICIES) + ('full', 'none'), default='size_tiered')
+    parser.add_argument('--threshold', help='Memtable size in bytes', type=int, default=1000000)
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--block-cache-bytes', type=int, default=8 * 1024 * 1024)
+    parser.add_argument('--compression', choices=('none', 'zlib'), default='none')
+    parser.add_argument('--blob-threshold', type=int, default=None)
+    parser.add_argument('--wal-durability', choices=('none', 'batch', 'interval'), default='batch')
+    parser.add_argument('--directory', help='Where the tree is created, a temporary directory by default')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='Write the results as json to this file')
+    return parser.parse_args()
+
+
+class ZipfianGenerator(object):
+    '''Gray et al. zipfian generator as used by YCSB, item 0 is the most popular.'''
+
+    def __init__(self, items: int, theta: float, rng: random.Random) -> None:
+        self.items: int = items
+        self.theta: float = theta
+        self.rng: random.Random = rng
+        self.zetan: float = sum(1 / (i ** theta) for i in range(1, items + 1))
+        self.alpha: float = 1 / (1 - theta)
+        self.eta: float = (1 - (2 / items) ** (1 - theta)) / (1 - (1 + 0.5 ** theta) / self.zetan)
+
+    def next(self) -> int:
+        u = self.rng.random()
+        uz = u * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return 1
+        return min(int(self.items * (self.eta * u - self.eta + 1) ** self.alpha), self.items - 1)
+
+
+class KeyChooser(object):
+    '''Picks existing records, zipfian ranks are scrambled so popular keys are spread over the key space.'''
+
+    def __init__(self, distribution: str, theta: float, rng: random.Random, records: int) -> None:
+        self.distribution: str = distribution
+        self.rng: random.Random = rng
+        self.records: int = records
+        self.zipfian: Optional[ZipfianGenerator] = ZipfianGenerator(records, theta, rng) if distribution == 'zipfian' else None
+
+    def next(self, records: int) -> int:
+        if self.zipfian is None:
+            return self.rng.randrange(records)
+        return hash64(str(self.zipfian.next()).encode(), signed=False)[0] % records
+
+
+def record_key(index: int) -> bytes:
+    # the same hashing the client applies to user keys
+    return hash_bytes(f'user{index}'.encode())
+
+
+class ValueFactory(object):
+
+    def __init__(self, args, rng: random.Random) -> None:
+        self.args = args
+        self.rng: random.Random = rng
+        if args.value_kind == 'random':
+            self.pool: bytes = rng.randbytes(args.value_size * 16)
+        else:
+            words = [f'"field{i}": "value {rng.randrange(1000)} lorem ipsum"' for i in range(64)]
+            self.pool = (', '.join(words).encode() * (args.value_size * 16 // 2000 + 2))[:args.value_size * 16]
+
+    def next(self) -> Record:
+        size = self.args.value_size
+        if self.args.value_size_distribution == 'uniform':
+            size = self.rng.randint(self.args.min_value_size, self.args.value_size)
+        start = self.rng.randrange(len(self.pool) - size + 1)
+        return Record('application/json', 'utf8', self.pool[start:start + size])
+
+
+class Latencies(object):
+
+    def __init__(self) -> None:
+        self.samples: Dict[str, List[int]] = {}
+
+    def time(self, operation: str, action: Callable):
+        start = time.perf_counter_ns()
+        result = action()
+        self.samples.setdefault(operation, []).append(time.perf_counter_ns() - start)
+        return result
+
+    def summary(self) -> Dict[str, dict]:
+        summary = {}
+        for operation, samples in self.samples.items():
+            samples = sorted(samples)
+            summary[operation] = {
+                'count': len(samples),
+                'mean_us': sum(samples) / len(samples) / 1000,
+                **{f'p{p}_us': samples[min(int(len(samples) * p / 100), len(samples) - 1)] / 1000 for p in PERCENTILES},
+                'max_us': samples[-1] / 1000
+            }
+        return summary
+
+
+def bytes_written() -> Optional[int]:
+    # every write syscall of the process: WAL, segments, blobs and manifest
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def directory_size(path: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+def peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark(object):
+
+    def __init__(self, args) -> None:
+        self.args = args
+        self.rng: random.Random = random.Random(args.seed)
+        self.values: ValueFactory = ValueFactory(args, self.rng)
+        self.chooser: KeyChooser = KeyChooser(args.distribution, args.zipfian_constant, self.rng, args.records)
+        self.directory: str = args.directory or tempfile.mkdtemp(prefix='ycsb-')
+        self.records: int = 0
+        self.live_bytes: Dict[int, int] = {}  # logical size of every key, for space amplification
+        self.written_bytes: int = 0
+        self.read_bytes: int = 0  # returned by point reads
+
+        options = {
+            'threshold': args.threshold,
+            'block_size': args.block_size,
+            'block_cache_bytes': args.block_cache_bytes,
+            'compression': get_codec(args.compression),
+            'blob_threshold': args.blob_threshold,
+            'wal_durability': args.wal_durability,
+            'compaction_policy': POLICIES[args.compaction]() if args.compaction in POLICIES else None
+        }
+        if args.target == 'database':
+            self.database: Optional[Database] = Database('segment-1', self.directory, 'wal', **options)
+            self.tree: LSMTree = self.database.db
+        else:
+            self.database = None
+            self.tree = LSMTree('segment-1', self.directory, 'wal', **options)
+
+    def write(self, index: int) -> None:
+        key, value = record_key(index), self.values.next()
+        if self.database:
+            self.database.set(key, value)
+        else:
+            self.tree.db_set(key, value)
+        self.written_bytes += len(key) + len(value.value)
+        self.live_bytes[index] = len(key) + len(value.value)
+
+    def read(self, index: int) -> None:
+        # point reads only, read amplification is the segment bytes they touched per logical byte returned
+        key = record_key(index)
+        found = self.database.get(key) if self.database else self.tree.db_get(key)
+        if found:
+            self.read_bytes += self.live_bytes[index]
+
+    def scan(self, index: int) -> None:
+        length = self.rng.randint(1, self.args.scan_length)
+        for _ in self.tree.scan(record_key(index), None, length):
+            pass
+
+    def load(self, latencies: Latencies) -> None:
+        for index in range(self.args.records):
+            latencies.time('insert', lambda: self.write(index))
+        self.records = self.args.records
+
+    def flush(self) -> None:
+        self.tree.flush()
+
+    def compact(self) -> None:
+        if self.args.compaction == 'full':
+            if len(self.tree.segments) > 1:
+                self.tree.compact(self.tree.segments[:], 1)
+            return
+        compactor = self.tree.compactor
+        if compactor is None:
+            return
+        # until the policy has nothing left to do
+        while True:
+            compactor.schedule()
+            with compactor.lock:
+                idle = compactor.in_flight == 0 and not compactor.policy.pick(self.tree, compactor.busy)
+            if idle:
+                return
+            time.sleep(0.05)
+
+    def run(self, latencies: Latencies) -> None:
+        mix = WORKLOADS[self.args.workload]
+        operations, weights = list(mix), list(mix.values())
+        for _ in range(self.args.operations):
+            operation = self.rng.choices(operations, weights)[0]
+            if operation == 'insert':
+                index = self.records
+                self.records += 1
+                latencies.time(operation, lambda: self.write(index))
+            else:
+                index = self.chooser.next(self.records)
+                action = {'read': self.read, 'update': self.write, 'scan': self.scan}[operation]
+                latencies.time(operation, lambda: action(index))
+
+    def phase(self, name: str, action: Callable, operations: int = 0) -> dict:
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        result = {'seconds': elapsed}
+        if operations:
+            result['ops_per_second'] = operations / elapsed if elapsed else None
+        print(f'{name}: {elapsed:.2f}s' + (f', {operations / elapsed:.0f} ops/s' if operations and elapsed else ''))
+        return result
+
+    def execute(self) -> dict:
+        written_before = bytes_written()
+        load_latencies, run_latencies = Latencies(), Latencies()
+
+        phases = {
+            'load': self.phase('load', lambda: self.load(load_latencies), self.args.records),
+            'flush': self.phase('flush', self.flush),
+            'compaction': self.phase('compaction', self.compact)
+        }
+        bytes_read_before, read_bytes_before = self.tree.bytes_read(), self.read_bytes
+        phases['run'] = self.phase('run', lambda: self.run(run_latencies), self.args.operations)
+        bytes_read = self.tree.bytes_read() - bytes_read_before
+        logical_read = self.read_bytes - read_bytes_before
+        self.flush()
+
+        written = bytes_written()
+        disk_bytes = directory_size(self.directory)
+        live = sum(self.live_bytes.values())
+        return {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'config': vars(self.args),
+            'phases': phases,
+            'latency': {'load': load_latencies.summary(), 'run': run_latencies.summary()},
+            'write_amplification': (written - written_before) / self.written_bytes if written is not None and self.written_bytes else None,
+            'read_amplification': bytes_read / logical_read if logical_read else None,
+            'space_amplification': disk_bytes / live if live else None,
+            'disk_bytes': disk_bytes,
+            'segments': len(self.tree.segments),
+            'block_cache_hit_rate': self.tree.block_cache.hit_rate() if self.tree.block_cache else None,
+            'peak_rss_bytes': peak_rss_bytes()
+        }
+
+    def close(self) -> None:
+        self.tree.close()
+        if not self.args.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.execute()
+    finally:
+        benchmark.close()
+
+    for operation, stats in results['latency']['run'].items():
+        print(f"{operation}: p50 {stats['p50_us']:.1f}us, p99 {stats['p99_us']:.1f}us, max {stats['max_us']:.1f}us")
+    for metric in ('write_amplification', 'read_amplification', 'space_amplification'):
+        print(f"{metric}: {results[metric]:.2f}" if results[metric] is not None else f'{metric}: n/a')
+    print(f"peak rss: {results['peak_rss_bytes'] / 1024 / 1024:.1f}mb")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
@@ -1,48 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from http import HTTPStatus
-from re import L
-from typing import List
-import requests
+import json
+from http.client import HTTPException
+from typing import Any, Callable, Dict, List, NamedTuple, Union
 
+from libs.metrics import CONTENT_TYPE, Registry
 from libs.singleton import Singleton
+from .pool import BackendPool, Response
+from .routing import KEY_SIZE, RoutingTable
+
+
+# actions timed by the request latency histogram
+ACTIONS = ('ping', 'query', 'mquery', 'set', 'delete')
+
+
+class BadRequest(Exception):
+    '''A request the frontend cannot route, it is answered with 400 Bad Request.'''
+
+
+class Call(NamedTuple):
+    '''One request to a backend node.'''
+    method: str
+    node: str
+    action: str
+    kwargs: Dict[str, Any]
+
+
+class Plan(NamedTuple):
+    '''The backend requests answering a client request, `answer` turns their responses into the reply.'''
+    calls: List[Call]
+    answer: Callable[[List[Response]], tuple]
+
+
+def parse_key(key) -> bytes:
+    try:
+        return bytes.fromhex(key.decode() if isinstance(key, bytes) else key)
+    except (TypeError, ValueError):
+        raise BadRequest(f'Malformed key {key!r}, keys are hex strings')
+
+
+class Frontend(object):
+    '''Parsing, routing and replies of the frontend API, the servers only send the backend requests of a `Plan`.'''
+
+    def __init__(self, routing: RoutingTable, pool) -> None:
+        self.routing: RoutingTable = routing
+        # kept alive connections to every backend node
+        self.pool = pool
+        self.metrics = Registry()
+        self.request_seconds = {
+            action: self.metrics.histogram('kvdb_frontend_request_seconds', 'Time to answer a client request', action=action)
+            for action in ACTIONS
+        }
+        for node in routing.nodes:
+            node_pool = self.pool.node(node)
+            self.metrics.gauge('kvdb_backend_idle_connections', 'Idle pooled connections to a backend', node_pool.idle_connections, node=node)
+            self.metrics.gauge('kvdb_backend_up', 'Whether requests are being sent to a backend', node_pool.healthy, node=node)
+
+    def timer(self, action: str):
+        timer = self.request_seconds.get(action)
+        return nullcontext() if timer is None else timer.time()
+
+    def route(self, action: str, fn_arg) -> Union[tuple, Plan]:
+        # either the reply itself or the backend requests to send for it
+        try:
+            match action:
+                case 'ping':
+                    return ('PONG', HTTPStatus.OK)
+                case 'metrics':
+                    return self.metrics.expose(), HTTPStatus.OK, CONTENT_TYPE
+                case 'query':
+                    return self.query(fn_arg)
+                case 'mquery':
+                    return self.multi_query(fn_arg)
+                case 'set':
+                    return self.set(fn_arg)
+                case 'delete':
+                    return self.delete(fn_arg)
+                case _:
+                    return (f'Action "{action}" does not exist!',  HTTPStatus.BAD_REQUEST)
+        except BadRequest as e:
+            return str(e), HTTPStatus.BAD_REQUEST
+
+    def search_partion(self, key: bytes) -> str:
+        node = self.routing.lookup(key)
+        if not node:
+            raise BadRequest(f'Keys must be {KEY_SIZE} bytes long, got {len(key)}')
+        return node
+
+    def backend_seconds(self, call: Call):
+        return self.metrics.histogram('kvdb_backend_request_seconds', 'Time waiting on a backend', node=call.node, action=call.action).time()
+
+    def answered(self, call: Call, res: Response) -> Response:
+        self.metrics.counter('kvdb_backend_responses_total', 'Backend answers by status code', node=call.node, status=str(res.status_code)).inc()
+        return res
+
+    def unreachable(self, call: Call, error: Exception) -> Response:
+        print(error)
+        return Response(HTTPStatus.BAD_GATEWAY, f'Node {call.node} did not answer'.encode())
+
+    def query(self, data=None) -> Plan:
+        node = self.search_partion(parse_key(data))
+        return Plan([Call('POST', node, 'query', {'data': data})], self.relay)
+
+    def multi_query(self, data=None) -> Plan:
+        if not isinstance(data, list):
+            raise BadRequest('A multi query takes a list of keys')
+        # keys are grouped by node and every node is asked once, all of them at the same time
+        by_node: Dict[str, List[str]] = {}
+        for key in data:
+            by_node.setdefault(self.search_partion(parse_key(key)), []).append(key)
+        return Plan([Call('POST', node, 'mquery', {'json': keys}) for node, keys in by_node.items()], self.merge)
+
+    def set(self, data=None) -> Plan:
+        return Plan([Call('PUT', self.search_partion(self.record_key(data)), 'set', {'json': data})], self.relay)
+
+    def delete(self, data=None) -> Plan:
+        return Plan([Call('PUT', self.search_partion(self.record_key(data)), 'delete', {'json': data})], self.relay)
+
+    def record_key(self, data) -> bytes:
+        if not isinstance(data, dict) or 'key' not in data:
+            raise BadRequest('The request must be a json object with a "key"')
+        return parse_key(data['key'])
+
+    def relay(self, responses: List[Response]) -> tuple:
+        res, = responses
+        return res.content, res.status_code
+
+    def merge(self, responses: List[Response]) -> tuple:
+        values = {}
+        for res in responses:
+            if not res.ok:
+                return res.content, res.status_code
+            values.update(res.json())
+        return json.dumps(values), HTTPStatus.OK
+
 
 @Singleton
-class API(object):
+class API(Frontend):
 
-    def __init__(self, dht_lookup):
-        self.dht_lookup = dht_lookup
+    def __init__(self, routing: RoutingTable, pool=None, workers: int = 32):
+        super().__init__(routing, pool or BackendPool())
+        # every request the server handles at once may ask all the nodes at the same time, so none waits on another
+        self.fan_out = ThreadPoolExecutor(max_workers=workers * max(len(routing.nodes), 1), thread_name_prefix='fan-out')
 
     def process_request(self, method, fn_arg):
-        match method := method.path[1:]:
-            case 'ping':
-                return ('PONG', HTTPStatus.OK)
-            case 'query':
-                return self.query(fn_arg)
-            case 'set':
-                return self.set(fn_arg)
-            case _:
-                return (f'Action "{method}" does not exist!',  HTTPStatus.BAD_REQUEST)
-
-    def search_partion(self, key):
-        for (start, end), node in self.dht_lookup.items():
-            if start <= key <= end:
-                return node
-        return None
-
-    def query(self, data=None):
-        key = bytes.fromhex(data.decode())
-        node = self.search_partion(key)
-        if not node:
-            return '', HTTPStatus.BAD_REQUEST
-        res = requests.post(f'http://{node}/query', data=data)
-        return res.json(), res.status_code
-
-    def set(self, data=None):
-        value = data
-        key = bytes.fromhex(value['key'])
-        node = self.search_partion(key)
-        if not node:
-            return '', HTTPStatus.BAD_REQUEST
-        res = requests.put(f'http://{node}/set', json=value)
-        return res.text, res.status_code
-    
-    
\ No newline at end of file
+        action = method.path[1:]
+        with self.timer(action):
+            plan = self.route(action, fn_arg)
+            if not isinstance(plan, Plan):
+                return plan
+            if len(plan.calls) == 1:
+                return plan.answer([self.forward(plan.calls[0])])
+            return plan.answer(list(self.fan_out.map(self.forward, plan.calls)))
+
+    def forward(self, call: Call) -> Response:
+        with self.backend_seconds(call):
+            try:
+                res = self.pool.request(call.method, call.node, call.action, **call.kwargs)
+            except (OSError, HTTPException) as e:
+                res = self.unreachable(call, e)
+        return self.answered(call, res)
@@ -0,0 +1,160 @@
+import asyncio
+from json import dumps
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+from .pool import Response
+
+
+Connection = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+# a kept alive connection the backend closed in the meantime fails like this on reuse, the request is retried on another one
+STALE_CONNECTION_ERRORS = (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError)
+
+
+def parse_head(head: bytes) -> Tuple[str, Dict[str, str]]:
+    # the start line and the headers, with lower cased names, of a message head ending in an empty line
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+class AsyncNodePool(object):
+    '''Keep-alive connections to one backend node, for the asyncio frontend, see NodePool.'''
+
+    def __init__(
+        self,
+        node: str,
+        max_size: int = 8,
+        timeout: float = 5.0,
+        idle_timeout: float = 10.0,
+        max_failures: int = 3,
+        retry_after: float = 1.0
+    ) -> None:
+        self.node: str = node
+        self.host, port = node.split(':')
+        self.port: int = int(port)
+        self.timeout: float = timeout
+        self.idle_timeout: float = idle_timeout
+        self.slots: asyncio.Semaphore = asyncio.Semaphore(max_size)
+        self.idle: List[Tuple[Connection, float]] = []
+
+        self.max_failures: int = max_failures
+        self.retry_after: float = retry_after
+        self.failures: int = 0
+        self.down_until: float = 0.0
+
+    async def request(self, method: str, path: str, body: bytes = b'', headers: Optional[Dict[str, str]] = None) -> Response:
+        if monotonic() < self.down_until:
+            raise ConnectionError(f'Node {self.node} is down, {self.failures} requests in a row failed')
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'No free connection to {self.node} after {self.timeout}s')
+        try:
+            head = f'{method} {path} HTTP/1.1\r\nHost: {self.node}\r\nContent-Length: {len(body)}\r\n'
+            head += ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+            message = head.encode('latin-1') + b'\r\n' + body
+            while True:
+                connection = self.checkout()
+                reused = connection is not None
+                try:
+                    if connection is None:
+                        connection = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                    response, keep_alive = await asyncio.wait_for(self.exchange(connection, message), self.timeout)
+                except STALE_CONNECTION_ERRORS:
+                    self.discard(connection)
+                    if reused:
+                        continue
+                    self.failed()
+                    raise
+                except (OSError, asyncio.TimeoutError, ValueError):
+                    self.discard(connection)
+                    self.failed()
+                    raise
+                self.failures = 0
+                if keep_alive:
+                    self.idle.append((connection, monotonic()))
+                else:
+                    self.discard(connection)
+                return response
+        finally:
+            self.slots.release()
+
+    async def exchange(self, connection: Connection, message: bytes) -> Tuple[Response, bool]:
+        reader, writer = connection
+        writer.write(message)
+        await writer.drain()
+        status_line, headers = parse_head(await reader.readuntil(b'\r\n\r\n'))
+        version, status, _ = (status_line.split(' ', 2) + [''])[:3]
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content, keep_alive = await reader.read(), False
+        return Response(int(status), content), keep_alive
+
+    def checkout(self) -> Optional[Connection]:
+        # the most recently used idle connection, None when a new one has to be opened
+        now = monotonic()
+        while self.idle:
+            connection, last_used = self.idle.pop()
+            if now - last_used < self.idle_timeout:
+                return connection
+            self.discard(connection)
+        return None
+
+    def discard(self, connection: Optional[Connection]) -> None:
+        if connection is not None:
+            connection[1].close()
+
+    def failed(self) -> None:
+        # the other idle connections most likely broke the same way, they are dropped instead of tried one by one
+        self.failures += 1
+        if self.failures >= self.max_failures:
+            self.down_until = monotonic() + self.retry_after
+        idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+
+    def idle_connections(self) -> int:
+        return len(self.idle)
+
+    def healthy(self) -> bool:
+        return monotonic() >= self.down_until
+
+    def close(self) -> None:
+        idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            self.discard(connection)
+
+
+class AsyncBackendPool(object):
+    '''One AsyncNodePool per backend node, they are created on first use.'''
+
+    def __init__(self, **options) -> None:
+        self.options = options
+        self.nodes: Dict[str, AsyncNodePool] = {}
+
+    def node(self, node: str) -> AsyncNodePool:
+        pool = self.nodes.get(node)
+        if pool is None:
+            pool = self.nodes[node] = AsyncNodePool(node, **self.options)
+        return pool
+
+    async def request(self, method: str, node: str, action: str, data: Optional[bytes | str] = None, json: Optional[Any] = None) -> Response:
+        headers = {}
+        if json is not None:
+            data = dumps(json)
+            headers['Content-Type'] = 'application/json'
+        if isinstance(data, str):
+            data = data.encode()
+        return await self.node(node).request(method, f'/{action}', data or b'', headers)
+
+    def close(self) -> None:
+        for pool in list(self.nodes.values()):
+            pool.close()
@@ -0,0 +1,106 @@
+import asyncio
+from http import HTTPStatus
+from http.client import HTTPException
+import json
+from urllib.parse import urlparse
+
+from .api import Call, Frontend, Plan
+from .async_pool import AsyncBackendPool, parse_head
+from .pool import Response
+from .routing import RoutingTable
+
+
+# idle client connections are closed after this many seconds
+KEEP_ALIVE_TIMEOUT = 10
+# biggest request head accepted, the body is bounded by its content length
+MAX_HEAD_BYTES = 64 * 1024
+
+
+class AsyncAPI(Frontend):
+    '''The frontend API of api.API for the asyncio server, backend calls do not block other clients.'''
+
+    async def process_request(self, method, fn_arg):
+        action = method.path[1:]
+        with self.timer(action):
+            plan = self.route(action, fn_arg)
+            if not isinstance(plan, Plan):
+                return plan
+            return plan.answer(await asyncio.gather(*(self.forward(call) for call in plan.calls)))
+
+    async def forward(self, call: Call) -> Response:
+        with self.backend_seconds(call):
+            try:
+                res = await self.pool.request(call.method, call.node, call.action, **call.kwargs)
+            except (OSError, HTTPException, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                res = self.unreachable(call, e)
+        return self.answered(call, res)
+
+
+class AsyncRouter(object):
+    '''HTTP/1.1 server answering every client connection in its own task, connections are kept alive.'''
+
+    def __init__(self, api: AsyncAPI) -> None:
+        self.api: AsyncAPI = api
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while await self.handle_one_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_one_request(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+        request_line, headers = parse_head(head)
+        try:
+            command, path, version = request_line.split(' ', 2)
+            content = await reader.readexactly(int(headers.get('content-length', 0)))
+        except ValueError:
+            await self.send_response(writer, 'Malformed request', HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+
+        if command == 'GET':
+            fn_arg = None
+        else:
+            try:
+                fn_arg = json.loads(content)
+            except json.JSONDecodeError:
+                fn_arg = content
+        try:
+            response = await self.api.process_request(urlparse(path), fn_arg)
+        except Exception as e:
+            print(e)
+            response = ('Internal error', HTTPStatus.INTERNAL_SERVER_ERROR)
+        await self.send_response(writer, *response, keep_alive=keep_alive)
+        return keep_alive
+
+    async def send_response(self, writer: asyncio.StreamWriter, result, status_code, content_type='application/json', keep_alive=True) -> None:
+        body = result if isinstance(result, bytes) else str(result).encode()
+        status = HTTPStatus(status_code)
+        head = (
+            f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+        )
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(host: str, port: int, routing: RoutingTable, pool: AsyncBackendPool) -> None:
+    router = AsyncRouter(AsyncAPI(routing, pool))
+    server = await asyncio.start_server(router.handle, host, port, limit=MAX_HEAD_BYTES, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+def run_async_frontend(host: str, port: int, routing: RoutingTable, **pool_options) -> None:
+    asyncio.run(serve(host, port, routing, AsyncBackendPool(**pool_options)))
@@ -0,0 +1,155 @@
+from http import HTTPStatus
+from http.client import HTTPConnection, HTTPException, RemoteDisconnected
+from json import dumps, loads
+from threading import BoundedSemaphore, Lock
+from time import monotonic
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+
+# a kept alive connection the backend closed in the meantime fails like this on reuse, the request is retried on another one
+STALE_CONNECTION_ERRORS = (RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
+
+class Response(NamedTuple):
+    status_code: int
+    content: bytes
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < HTTPStatus.BAD_REQUEST
+
+    @property
+    def text(self) -> str:
+        return self.content.decode()
+
+    def json(self) -> Any:
+        return loads(self.content)
+
+
+class NodePool(object):
+    '''Keep-alive connections to one backend node.'''
+
+    def __init__(
+        self,
+        node: str,
+        max_size: int = 8,
+        timeout: float = 5.0,
+        idle_timeout: float = 10.0,
+        max_failures: int = 3,
+        retry_after: float = 1.0
+    ) -> None:
+        self.node: str = node
+        self.host, port = node.split(':')
+        self.port: int = int(port)
+        self.timeout: float = timeout  # connect, read and wait for a free connection, in seconds
+        # must stay below the keep-alive timeout of the backend so it never closes a connection being reused
+        self.idle_timeout: float = idle_timeout
+        # at most max_size connections are open at once, the idle ones are reused newest first
+        self.slots: BoundedSemaphore = BoundedSemaphore(max_size)
+        self.idle: List[Tuple[HTTPConnection, float]] = []
+        self.lock: Lock = Lock()
+
+        # after max_failures failures in a row the node is skipped for retry_after seconds
+        self.max_failures: int = max_failures
+        self.retry_after: float = retry_after
+        self.failures: int = 0
+        self.down_until: float = 0.0
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Response:
+        if monotonic() < self.down_until:
+            raise ConnectionError(f'Node {self.node} is down, {self.failures} requests in a row failed')
+        if not self.slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f'No free connection to {self.node} after {self.timeout}s')
+        try:
+            while True:
+                connection, reused = self.checkout()
+                try:
+                    connection.request(method, path, body, headers or {})
+                    response = connection.getresponse()
+                    content = response.read()
+                except STALE_CONNECTION_ERRORS:
+                    connection.close()
+                    if reused:
+                        continue
+                    self.failed()
+                    raise
+                except (OSError, HTTPException):
+                    connection.close()
+                    self.failed()
+                    raise
+                self.succeeded()
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.checkin(connection)
+                return Response(response.status, content)
+        finally:
+            self.slots.release()
+
+    def checkout(self) -> Tuple[HTTPConnection, bool]:
+        now = monotonic()
+        with self.lock:
+            while self.idle:
+                connection, last_used = self.idle.pop()
+                if now - last_used < self.idle_timeout:
+                    return connection, True
+                connection.close()
+        return HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def checkin(self, connection: HTTPConnection) -> None:
+        with self.lock:
+            self.idle.append((connection, monotonic()))
+
+    def succeeded(self) -> None:
+        self.failures = 0
+
+    def failed(self) -> None:
+        # the other idle connections most likely broke the same way, they are dropped instead of tried one by one
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.down_until = monotonic() + self.retry_after
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            connection.close()
+
+    def idle_connections(self) -> int:
+        return len(self.idle)
+
+    def healthy(self) -> bool:
+        return monotonic() >= self.down_until
+
+    def close(self) -> None:
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+class BackendPool(object):
+    '''One NodePool per backend node, they are created on first use.'''
+
+    def __init__(self, **options) -> None:
+        self.options = options
+        self.nodes: Dict[str, NodePool] = {}
+        self.lock: Lock = Lock()
+
+    def node(self, node: str) -> NodePool:
+        pool = self.nodes.get(node)
+        if pool is None:
+            with self.lock:
+                pool = self.nodes.setdefault(node, NodePool(node, **self.options))
+        return pool
+
+    def request(self, method: str, node: str, action: str, data: Optional[bytes | str] = None, json: Optional[Any] = None) -> Response:
+        headers = {}
+        if json is not None:
+            data = dumps(json)
+            headers['Content-Type'] = 'application/json'
+        if isinstance(data, str):
+            data = data.encode()
+        return self.node(node).request(method, f'/{action}', data, headers)
+
+    def close(self) -> None:
+        for pool in list(self.nodes.values()):
+            pool.close()
@@ -1,11 +1,11 @@
 from enum import Enum
 from http import HTTPStatus
-from http.server import BaseHTTPRequestHandler
 import re
 from typing import List
 from urllib.parse import urlparse
 import json
 
+from libs.http_server import BoundedRequestHandler
 from .api import API
 
 
@@ -15,18 +15,27 @@ class HTTPMethod(Enum):
     PUT = 3
 
 
-def makeHTTPHandler(dht_lookup):
-    class HTTPHandler(BaseHTTPRequestHandler):
+def makeHTTPHandler(routing, pool=None, workers=32):
+    class HTTPHandler(BoundedRequestHandler):
 
-        def __send_response(self, result, status_code) -> None:
+        # connections are kept alive, an idle one is closed after `timeout` seconds to free its thread
+        protocol_version = 'HTTP/1.1'
+        timeout = 10
+        # headers and body are separate writes, without this the second one waits on the delayed ack of the first
+        disable_nagle_algorithm = True
+
+        def __send_response(self, result, status_code, content_type='application/json') -> None:
+            body = result if isinstance(result, bytes) else str(result).encode()
             self.send_response(status_code)
-            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
             self.end_headers()
-            self.wfile.write(str(result).encode())
+            self.wfile.write(body)
 
         def do_GET(self) -> None:
-            result, status_code = API.instance(dht_lookup).process_request(urlparse(self.path), fn_arg=None)
-            return self.__send_response(result, status_code)
+            return self.__send_response(
+                *API.instance(routing, pool, workers).process_request(urlparse(self.path), fn_arg=None)
+            )
 
         def do_POST(self) -> None:
             return self.__send_response(
@@ -46,7 +55,6 @@ def makeHTTPHandler(dht_lookup):
             except json.JSONDecodeError:
                 content = content_
             finally:
-                result, status_code = API.instance(dht_lookup).process_request(urlparse(self.path), fn_arg=content)
-                return result, status_code
+                return API.instance(routing, pool, workers).process_request(urlparse(self.path), fn_arg=content)
 
     return HTTPHandler
\ No newline at end of file
@@ -0,0 +1,81 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import mmh3
+
+
+KEY_SIZE = 16  # keys are 128 bit mmh3 hashes
+MAX_KEY = 2 ** (8 * KEY_SIZE) - 1
+
+Range = Tuple[bytes, bytes]  # first and last key, both included
+
+
+def key_bytes(key: int) -> bytes:
+    # big endian, so comparing the bytes orders keys like the numbers they stand for
+    return key.to_bytes(KEY_SIZE, byteorder='big', signed=False)
+
+
+class RoutingTable(object):
+    '''Maps a key to its node in O(log n): the key space is split into ranges, each owned by a node.'''
+
+    def __init__(self, ends: Sequence[bytes], owners: Sequence[str]) -> None:
+        # ranges are sorted, one ends where the next starts and the last one ends at the largest key
+        if len(ends) != len(owners) or not ends or ends[-1] != key_bytes(MAX_KEY):
+            raise ValueError('Ranges must cover the whole key space')
+        self.ends: List[bytes] = list(ends)
+        self.owners: List[str] = list(owners)
+        self.nodes: List[str] = list(dict.fromkeys(owners))
+
+    def lookup(self, key: bytes) -> Optional[str]:
+        if len(key) != KEY_SIZE:
+            return None
+        return self.owners[bisect_left(self.ends, key)]
+
+    def ranges(self) -> Dict[str, List[Range]]:
+        # adjacent ranges of the same node are merged
+        ranges: Dict[str, List[Range]] = {node: [] for node in self.nodes}
+        start = 0
+        for position, (end, owner) in enumerate(zip(self.ends, self.owners)):
+            if position + 1 < len(self.owners) and self.owners[position + 1] == owner:
+                continue
+            ranges[owner].append((key_bytes(start), end))
+            start = int.from_bytes(end, 'big') + 1
+        return ranges
+
+    def shares(self) -> Dict[str, float]:
+        # fraction of the key space every node owns
+        return {
+            node: sum(int.from_bytes(end, 'big') - int.from_bytes(start, 'big') + 1 for start, end in ranges) / (MAX_KEY + 1)
+            for node, ranges in self.ranges().items()
+        }
+
+    @classmethod
+    def even(cls, nodes: Sequence[str], weights: Optional[Sequence[int]] = None) -> 'RoutingTable':
+        # one contiguous range per node, sized by its weight
+        weights = weights or [1] * len(nodes)
+        total = sum(weights)
+        ends, owners = [], []
+        covered = 0
+        for node, weight in zip(nodes, weights):
+            covered += weight
+            ends.append(key_bytes((MAX_KEY + 1) * covered // total - 1))
+            owners.append(node)
+        return cls(ends, owners)
+
+    @classmethod
+    def ring(cls, nodes: Sequence[str], vnodes: int, weights: Optional[Sequence[int]] = None) -> 'RoutingTable':
+        # consistent hashing: every node hashes to vnodes * weight tokens, a key belongs to the first token at or after it,
+        # adding or removing a node only moves the keys next to its own tokens
+        weights = weights or [1] * len(nodes)
+        tokens = sorted(
+            (mmh3.hash_bytes(f'{node}#{replica}'), node)
+            for node, weight in zip(nodes, weights)
+            for replica in range(vnodes * weight)
+        )
+        ends = [token for token, _ in tokens]
+        owners = [node for _, node in tokens]
+        # keys past the last token wrap around to the first one
+        if ends[-1] != key_bytes(MAX_KEY):
+            ends.append(key_bytes(MAX_KEY))
+            owners.append(owners[0])
+        return cls(ends, owners)
@@ -1,20 +1,158 @@
-from typing import Any
+import os
+import struct
+from pathlib import Path
+from threading import Condition, Event, Lock, Thread
+from typing import Iterator, List, Optional
+from zlib import crc32
 
-from .singleton import Singleton
+
+# Binary log layout: a header followed by frames of (length, crc32, payload).
+# A torn or corrupted frame marks the end of the log.
+MAGIC = b'YWAL'
+VERSION = 1
+HEADER = struct.Struct('<4sH')  # magic, version
+FRAME = struct.Struct('<II')  # payload length, payload crc32
+
+DURABILITY_MODES = ('none', 'batch', 'interval')
 
 
-@Singleton
 class AppendLog(object):
-    def __init__(self, filename: str) -> None:
+
+    def __init__(self, filename: str, durability: str = 'batch', sync_interval: float = 0.05) -> None:
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Durability must be one of {DURABILITY_MODES}, got "{durability}"')
         self.filename = filename
-        self.stream = open(filename, 'a')
+        self.durability: str = durability
+        self.sync_interval: float = sync_interval
+
+        if AppendLog.is_binary(filename):
+            valid_length = AppendLog.valid_length(filename)
+            with open(filename, 'r+b') as log_file:
+                log_file.truncate(valid_length)  # drop a torn tail before appending after it
+        self.stream = open(filename, 'ab')
+        if self.stream.tell() == 0:
+            self.write_header()
+
+        # group commit state, writers queue frames and one of them commits the whole batch
+        self.condition: Condition = Condition()
+        self.pending: List[bytes] = []
+        self.appended: int = 0
+        self.written: int = 0
+        self.writing: bool = False
+        self.error: Optional[Exception] = None
+
+        self.file_lock: Lock = Lock()
+        self.dirty: bool = False
+        self.closed: Event = Event()
+        self.syncer: Optional[Thread] = None
+        if durability == 'interval':
+            self.syncer = Thread(target=self.sync_periodically, name='wal-sync', daemon=True)
+            self.syncer.start()
+
+    @staticmethod
+    def is_binary(filename: str) -> bool:
+        if not Path(filename).exists():
+            return False
+        with open(filename, 'rb') as log_file:
+            header = log_file.read(HEADER.size)
+        return len(header) == HEADER.size and HEADER.unpack(header)[0] == MAGIC
+
+    @staticmethod
+    def replay(filename: str) -> Iterator[bytes]:
+        with open(filename, 'rb') as log_file:
+            log_file.seek(HEADER.size)
+            while True:
+                frame = log_file.read(FRAME.size)
+                if len(frame) < FRAME.size:
+                    return
+                length, checksum = FRAME.unpack(frame)
+                payload = log_file.read(length)
+                if len(payload) < length or crc32(payload) != checksum:
+                    return
+                yield payload
+
+    @staticmethod
+    def valid_length(filename: str) -> int:
+        return HEADER.size + sum(FRAME.size + len(payload) for payload in AppendLog.replay(filename))
 
-    def write(self, val: str) -> None:
-        try:
-            self.stream.write(val)
+    def write_header(self) -> None:
+        self.stream.write(HEADER.pack(MAGIC, VERSION))
+        self.stream.flush()
+
+    def write(self, payload: bytes) -> None:
+        self.wait(self.append(payload))
+
+    def append(self, payload: bytes) -> int:
+        # queues the frame, the log keeps the order of appends, the returned ticket is waited on for durability
+        frame = FRAME.pack(len(payload), crc32(payload)) + payload
+        with self.condition:
+            self.pending.append(frame)
+            self.appended += 1
+            return self.appended
+
+    def wait(self, ticket: int) -> None:
+        with self.condition:
+            while self.written < ticket:
+                if self.error:
+                    raise IOError(f'The log {self.filename} is unusable: {self.error}')
+                if self.writing:
+                    self.condition.wait()
+                    continue
+
+                # no commit in flight, this writer commits everything queued so far
+                self.writing = True
+                batch, self.pending = self.pending, []
+                last = self.appended
+                self.condition.release()
+                try:
+                    self.commit(b''.join(batch))
+                except Exception as e:
+                    # written stays put, so every writer of the failed batch, and any later one, sees the error
+                    self.error = e
+                    raise
+                else:
+                    self.written = last
+                finally:
+                    self.condition.acquire()
+                    self.writing = False
+                    self.condition.notify_all()
+
+    def commit(self, data: bytes) -> None:
+        with self.file_lock:
+            self.stream.write(data)
             self.stream.flush()
-        except IOError:
-            print('The file isn\'t currently open')
-    
+            if self.durability == 'batch':
+                os.fsync(self.stream.fileno())
+            else:
+                self.dirty = True
+
+    def sync(self) -> None:
+        with self.file_lock:
+            if self.dirty:
+                self.dirty = False
+                os.fsync(self.stream.fileno())
+
+    def sync_periodically(self) -> None:
+        while not self.closed.wait(self.sync_interval):
+            self.sync()
+
     def clear(self) -> None:
-        self.stream = open(self.filename, 'w')
+        with self.condition:
+            while self.writing:
+                self.condition.wait()
+            with self.file_lock:
+                self.stream.seek(0)
+                self.stream.truncate()
+                self.write_header()
+                if self.durability != 'none':
+                    os.fsync(self.stream.fileno())
+                self.dirty = False
+
+    def close(self) -> None:
+        if self.error is None:
+            self.wait(self.appended)  # frames appended by writers that have not waited yet
+        self.closed.set()
+        if self.syncer:
+            self.syncer.join()
+        self.sync()
+        self.stream.close()
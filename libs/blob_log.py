@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, NamedTuple, Set
+from zlib import crc32
+
+
+# Values too big to be rewritten by every flush and merge live in numbered,
+# append only blob files. Segments store a fixed size reference instead.
+BLOB_FILE_PREFIX = 'blobs-'
+BLOB_REF = struct.Struct('<IQII')  # file number, offset, length, crc32
+
+
+class BlobRef(NamedTuple):
+    file: int
+    offset: int
+    length: int
+    checksum: int
+
+    def pack(self) -> bytes:
+        return BLOB_REF.pack(*self)
+
+    @classmethod
+    def unpack(cls, buffer: bytes) -> 'BlobRef':
+        return cls(*BLOB_REF.unpack(buffer))
+
+
+class BlobLog(object):
+
+    def __init__(self, directory: str, max_file_bytes: int = 64 * 1024 * 1024) -> None:
+        self.directory: Path = Path(directory)
+        self.max_file_bytes: int = max_file_bytes
+        self.lock: Lock = Lock()
+        self.mappings: Dict[int, mmap.mmap] = {}
+        # collected files, a read that finds one gone looks its key up again
+        self.removed: Set[int] = set()
+
+        # appends continue on the newest file, which is therefore never collected
+        numbers = self.file_numbers()
+        self.number: int = numbers[-1] if numbers else 1
+        self.stream = None
+
+    def file_numbers(self) -> List[int]:
+        return sorted(int(path.name[len(BLOB_FILE_PREFIX):]) for path in self.directory.glob(f'{BLOB_FILE_PREFIX}*'))
+
+    def sealed_files(self) -> List[int]:
+        return [number for number in self.file_numbers() if number < self.number]
+
+    def append(self, value: bytes) -> BlobRef:
+        with self.lock:
+            if self.stream is None:
+                self.stream = open(self.path(self.number), 'ab')
+            if self.stream.tell() and self.stream.tell() + len(value) > self.max_file_bytes:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+                self.stream.close()
+                self.number += 1
+                self.stream = open(self.path(self.number), 'ab')
+            offset = self.stream.tell()
+            self.stream.write(value)
+            return BlobRef(self.number, offset, len(value), crc32(value))
+
+    def sync(self) -> None:
+        # called before a segment pointing at new blobs becomes visible
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+
+    def read(self, ref: BlobRef) -> bytes:
+        mapping = self.mappings.get(ref.file)
+        if mapping is None or len(mapping) < ref.offset + ref.length:
+            # the newest file keeps growing, its mapping is refreshed when a read goes past it
+            with self.lock:
+                if self.stream is not None and ref.file == self.number:
+                    self.stream.flush()
+                with open(self.path(ref.file), 'rb') as blob_file:
+                    mapping = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mappings[ref.file] = mapping
+        value = bytes(mapping[ref.offset:ref.offset + ref.length])
+        if crc32(value) != ref.checksum:
+            raise IOError(f'Corrupted blob at {ref} in {self.path(ref.file)}')
+        return value
+
+    def size(self, number: int) -> int:
+        return self.path(number).stat().st_size
+
+    def remove(self, number: int) -> None:
+        # lookups may still hold the mapping, it is released with the last reference
+        self.removed.add(number)
+        self.mappings.pop(number, None)
+        self.path(number).unlink(missing_ok=True)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.stream is not None:
+                self.stream.flush()
+                os.fsync(self.stream.fileno())
+                self.stream.close()
+                self.stream = None
+
+    def path(self, number: int) -> Path:
+        return self.directory / f'{BLOB_FILE_PREFIX}{number:06d}'
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional, Tuple
+
+
+class BlockCache(object):
+    '''LRU cache of decoded segment blocks bounded by an estimate of their size in bytes.'''
+
+    def __init__(self, capacity_bytes: int) -> None:
+        self.capacity_bytes: int = capacity_bytes
+        self.used_bytes: int = 0
+        self.entries: OrderedDict[Hashable, Tuple[Any, int]] = OrderedDict()
+        self.lock: Lock = Lock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        if size > self.capacity_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.capacity_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.used_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old[1]
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self.entries)
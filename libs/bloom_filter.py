@@ -1,32 +1,125 @@
 # Original code adapted from: https://github.com/chrislessard/LSM-Tree/blob/master/src/bloom_filter.py
 
 from math import log
-from typing import List
-from mmh3 import hash
+from typing import List, Sequence, Tuple
+from mmh3 import hash64
 import numpy as np
 
 
+# Probe i of an item is (h1 + i * h2) mod m, where h1 and h2 are the two halves
+# of a single 128 bit murmur3 digest (Kirsch & Mitzenmacher double hashing).
+HASH_SCHEME = 'mmh3_x64_128_double'
+MASK_64 = (1 << 64) - 1
+
+
+def optimal_size(num_items: int, false_positive_prob: float) -> Tuple[int, int]:
+    num_items = max(num_items, 1)
+    bit_array_size = max(int(-(num_items * log(false_positive_prob)) / (log(2)**2)), 8)
+    num_hash_fns = max(int((bit_array_size / num_items) * log(2)), 1)
+    return bit_array_size, num_hash_fns
+
+
+def digests(items: Sequence[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    pairs = np.array([hash64(item, signed=False) for item in items], dtype=np.uint64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def probe_positions(items: Sequence[bytes], num_hash_fns: int, bit_array_size: int) -> np.ndarray:
+    # one row per item, one column per probe, all computed at once (uint64 wraps like MASK_64)
+    h1, h2 = digests(items)
+    steps = np.arange(num_hash_fns, dtype=np.uint64)
+    return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(bit_array_size)
+
+
+def item_positions(item: bytes, num_hash_fns: int, bit_array_size: int) -> List[int]:
+    h1, h2 = hash64(item, signed=False)
+    return [((h1 + i * h2) & MASK_64) % bit_array_size for i in range(num_hash_fns)]
+
+
+class BloomFilter(object):
+    '''Bit packed bloom filter, one bit per slot.'''
+
+    def __init__(self, num_items: int, false_positive_prob: float) -> None:
+        self.false_positive_prob: float = false_positive_prob
+        self.bit_array_size, self.num_hash_fns = optimal_size(num_items, false_positive_prob)
+        self.bit_array: np.ndarray = np.zeros(shape=(self.bit_array_size + 7) // 8, dtype=np.uint8)
+
+    def add(self, item: bytes) -> None:
+        self.add_many([item])
+
+    def add_many(self, items: Sequence[bytes]) -> None:
+        if not len(items):
+            return
+        positions = probe_positions(items, self.num_hash_fns, self.bit_array_size).ravel()
+        masks = np.uint8(1) << (positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bit_array, positions >> np.uint64(3), masks)
+
+    def check(self, item: bytes) -> bool:
+        # a single probe is cheaper in plain python than through numpy
+        bits = self.bit_array.data
+        for position in item_positions(item, self.num_hash_fns, self.bit_array_size):
+            if not bits[position >> 3] >> (position & 7) & 1:
+                # if any bit is false, the item is definitely not present
+                return False
+        return True
+
+    def check_many(self, items: Sequence[bytes]) -> np.ndarray:
+        if not len(items):
+            return np.zeros(0, dtype=bool)
+        positions = probe_positions(items, self.num_hash_fns, self.bit_array_size)
+        bits = (self.bit_array[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def to_bytes(self) -> bytes:
+        return self.bit_array.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, bit_array_size: int, num_hash_fns: int, false_positive_prob: float) -> 'BloomFilter':
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.false_positive_prob = false_positive_prob
+        bloom_filter.bit_array_size = bit_array_size
+        bloom_filter.num_hash_fns = num_hash_fns
+        bloom_filter.bit_array = np.frombuffer(data, dtype=np.uint8).copy()
+        return bloom_filter
+
+
 class CountingBloomFilter(object):
+    '''One counter per slot so items can be removed, 8 times the memory of a BloomFilter.'''
+
     def __init__(self, num_items: int, false_positive_prob: float, dtype = np.uint8) -> None:
         self.false_positive_prob: float = false_positive_prob
-        self.bit_array_size: int = int(-(num_items * log(self.false_positive_prob)) / (log(2)**2))
-        self.num_hash_fns: int = int((self.bit_array_size/num_items) * log(2))
-
+        self.bit_array_size, self.num_hash_fns = optimal_size(num_items, false_positive_prob)
         self.bit_array: np.ndarray = np.zeros(shape=self.bit_array_size, dtype=dtype)
 
-    def add(self, item) -> None:
-        digests: List[bytes] = []
-        for seed in range(self.num_hash_fns):
-            # each seed creates a different digest.
-            digest: bytes = hash(item, seed) % self.bit_array_size
-            digests.append(digest)
+    def add(self, item: bytes) -> None:
+        self.add_many([item])
 
-            self.bit_array[digest] += 1
+    def add_many(self, items: Sequence[bytes]) -> None:
+        if not len(items):
+            return
+        np.add.at(self.bit_array, probe_positions(items, self.num_hash_fns, self.bit_array_size).ravel(), 1)
 
-    def check(self, item) -> bool:
-        for seed in range(self.num_hash_fns):
-            digest = hash(item, seed) % self.bit_array_size
-            if self.bit_array[digest] == 0.:
-                # if any bit is false, the item is not definitely present
+    def remove(self, item: bytes) -> None:
+        if not self.check(item):
+            return
+        positions = item_positions(item, self.num_hash_fns, self.bit_array_size)
+        np.subtract.at(self.bit_array, positions, 1)
+
+    def check(self, item: bytes) -> bool:
+        for position in item_positions(item, self.num_hash_fns, self.bit_array_size):
+            if self.bit_array[position] == 0:
                 return False
-        return True
\ No newline at end of file
+        return True
+
+    def check_many(self, items: Sequence[bytes]) -> np.ndarray:
+        if not len(items):
+            return np.zeros(0, dtype=bool)
+        return (self.bit_array[probe_positions(items, self.num_hash_fns, self.bit_array_size)] > 0).all(axis=1)
+
+    def to_bloom_filter(self) -> BloomFilter:
+        bloom_filter = BloomFilter.__new__(BloomFilter)
+        bloom_filter.false_positive_prob = self.false_positive_prob
+        bloom_filter.bit_array_size = self.bit_array_size
+        bloom_filter.num_hash_fns = self.num_hash_fns
+        bloom_filter.bit_array = np.packbits(self.bit_array > 0, bitorder='little')
+        return bloom_filter
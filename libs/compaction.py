@@ -0,0 +1,185 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock, Thread
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from libs.lsm_tree import LSMTree
+
+
+# A compaction job is a contiguous run of segments (oldest to newest) and the level its output lands on
+Job = Tuple[List[str], int]
+
+
+class CompactionPolicy(object):
+
+    def pick(self, tree: 'LSMTree', busy: Set[str]) -> List[Job]:
+        raise NotImplementedError
+
+
+class SizeTieredCompaction(CompactionPolicy):
+    '''Merges runs of adjacent segments whose sizes are within a bucket of each other.'''
+
+    def __init__(self, min_threshold: int = 4, max_threshold: int = 32, bucket_low: float = 0.5, bucket_high: float = 1.5) -> None:
+        self.min_threshold: int = min_threshold
+        self.max_threshold: int = max_threshold
+        self.bucket_low: float = bucket_low
+        self.bucket_high: float = bucket_high
+
+    def pick(self, tree: 'LSMTree', busy: Set[str]) -> List[Job]:
+        jobs: List[Job] = []
+        run: List[str] = []
+        run_bytes: int = 0
+
+        def close_run() -> None:
+            if len(run) >= self.min_threshold:
+                jobs.append((run[:self.max_threshold], 0))
+
+        for segment in tree.segments[:]:
+            if segment in busy:
+                close_run()
+                run, run_bytes = [], 0
+                continue
+            size = tree.segment_size(segment)
+            average = run_bytes / len(run) if run else size
+            if not self.bucket_low * average <= size <= self.bucket_high * average:
+                close_run()
+                run, run_bytes = [], 0
+            run.append(segment)
+            run_bytes += size
+        close_run()
+        return jobs
+
+
+class LeveledCompaction(CompactionPolicy):
+    '''
+    Flushed segments land on level 0, every deeper level is a single sorted run
+    `fanout` times bigger than the one above it. Segments are kept ordered from
+    the deepest level to level 0, so every job is a contiguous run.
+    '''
+
+    def __init__(self, level0_trigger: int = 4, base_level_bytes: Optional[int] = None, fanout: int = 10) -> None:
+        self.level0_trigger: int = level0_trigger
+        self.base_level_bytes: Optional[int] = base_level_bytes
+        self.fanout: int = fanout
+
+    def level_limit(self, tree: 'LSMTree', level: int) -> int:
+        base = self.base_level_bytes or tree.threshold * self.fanout
+        return base * self.fanout ** (level - 1)
+
+    def pick(self, tree: 'LSMTree', busy: Set[str]) -> List[Job]:
+        segments = tree.segments[:]
+        levels = [tree.levels.get(segment, 0) for segment in segments]
+        jobs: List[Job] = []
+
+        first_l0 = len(segments)
+        while first_l0 > 0 and levels[first_l0 - 1] == 0:
+            first_l0 -= 1
+        level0 = segments[first_l0:]
+        if len(level0) >= self.level0_trigger and not busy.intersection(level0):
+            run = level0
+            if first_l0 > 0 and levels[first_l0 - 1] == 1 and segments[first_l0 - 1] not in busy:
+                run = [segments[first_l0 - 1]] + level0
+            jobs.append((run, 1))
+
+        for position in range(first_l0):
+            segment, level = segments[position], levels[position]
+            if segment in busy or tree.segment_size(segment) <= self.level_limit(tree, level):
+                continue
+            previous = levels[position - 1] if position > 0 else None
+            if previous == level:
+                # pushed down from here it would land behind a segment of its old level, the level is merged first
+                if segments[position - 1] not in busy:
+                    jobs.append(([segments[position - 1], segment], level))
+            elif previous == level + 1:
+                if segments[position - 1] not in busy:
+                    jobs.append(([segments[position - 1], segment], level + 1))
+            else:
+                # first of its level with nothing below to merge into, it moves down in place
+                jobs.append(([segment], level + 1))
+        return jobs
+
+
+POLICIES = {
+    'size_tiered': SizeTieredCompaction,
+    'leveled': LeveledCompaction
+}
+
+
+class RateLimiter(object):
+    '''Token bucket shared by all the compactions of a tree, holds at most one second of burst.'''
+
+    def __init__(self, bytes_per_second: int) -> None:
+        self.rate: int = bytes_per_second
+        self.tokens: float = bytes_per_second
+        self.last: float = monotonic()
+        self.lock: Lock = Lock()
+
+    def consume(self, amount: int) -> None:
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+class Compactor(object):
+
+    def __init__(self, tree: 'LSMTree', policy: CompactionPolicy, max_concurrent: int = 1, bytes_per_second: Optional[int] = None, interval: float = 1.0) -> None:
+        self.tree: 'LSMTree' = tree
+        self.policy: CompactionPolicy = policy
+        self.max_concurrent: int = max_concurrent
+        self.rate_limiter: Optional[RateLimiter] = RateLimiter(bytes_per_second) if bytes_per_second else None
+        self.interval: float = interval
+
+        self.busy: Set[str] = set()
+        self.in_flight: int = 0
+        self.lock: Lock = Lock()
+        self.wakeup: Event = Event()
+        self.stopped: bool = False
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='compaction')
+        self.thread: Thread = Thread(target=self.run, name='compactor', daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def notify(self) -> None:
+        self.wakeup.set()
+
+    def run(self) -> None:
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if not self.stopped:
+                self.schedule()
+
+    def schedule(self) -> None:
+        with self.lock:
+            for segments, level in self.policy.pick(self.tree, self.busy):
+                if self.in_flight >= self.max_concurrent:
+                    break
+                if self.busy.intersection(segments):
+                    continue
+                self.busy.update(segments)
+                self.in_flight += 1
+                self.executor.submit(self.compact, segments, level)
+
+    def compact(self, segments: List[str], level: int) -> None:
+        try:
+            self.tree.compact(segments, level, self.rate_limiter)
+        except Exception as e:
+            print(e)
+        finally:
+            with self.lock:
+                self.busy.difference_update(segments)
+                self.in_flight -= 1
+            self.wakeup.set()
@@ -0,0 +1,42 @@
+import zlib
+
+
+class Codec(object):
+    '''Compresses whole segment blocks, the codec of a segment is named in its meta.'''
+
+    name: str = 'none'
+
+    def __init__(self, level: int = 0) -> None:
+        self.level: int = level
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCodec(Codec):
+
+    name = 'zlib'
+
+    def __init__(self, level: int = 6) -> None:
+        self.level: int = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+CODECS = {
+    'none': Codec,
+    'zlib': ZlibCodec
+}
+
+
+def get_codec(name: str, level: int | None = None) -> Codec:
+    if name not in CODECS:
+        raise ValueError(f'Compression must be one of {tuple(CODECS)}, got "{name}"')
+    return CODECS[name]() if level is None else CODECS[name](level)
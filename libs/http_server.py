@@ -0,0 +1,35 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import BoundedSemaphore
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    '''Serves every connection on its own thread, at most `workers` of them handle a request at the same time.'''
+
+    # connections are accepted as soon as they arrive, this only bounds the ones the kernel holds until then
+    request_queue_size = 128
+    daemon_threads = True
+
+    def __init__(self, server_address, RequestHandlerClass, workers: int = 16) -> None:
+        super().__init__(server_address, RequestHandlerClass)
+        # an idle kept alive connection waits on its own thread and holds no worker, so it never blocks other clients
+        self.workers: BoundedSemaphore = BoundedSemaphore(workers)
+
+
+class BoundedRequestHandler(BaseHTTPRequestHandler):
+    '''Holds one of the workers of a BoundedThreadingHTTPServer from the arrival of a request until it is answered.'''
+
+    def handle_one_request(self) -> None:
+        self.working: bool = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self.working:
+                self.server.workers.release()
+
+    def parse_request(self) -> bool:
+        # called once the request line came in, waiting for it took no worker
+        if not super().parse_request():
+            return False
+        self.server.workers.acquire()
+        self.working = True
+        return True
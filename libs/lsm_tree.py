@@ -1,191 +1,640 @@
 # Original code adapted from: https://github.com/chrislessard/LSM-Tree/blob/master/src/lsm_tree.py
 
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+import heapq
 from operator import le
 import pickle
 from pathlib import Path
-from typing import List, Optional
+from queue import Queue
+from threading import Condition, Lock, RLock, Thread
+from time import perf_counter, sleep
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 import json
 from os import remove as remove_file, rename as rename_file
 
 from libs.red_black_tree import RedBlackTree
-from libs.bloom_filter import CountingBloomFilter
-from libs.types import Value
+from libs.types import TOMBSTONE, Record, Value
 from libs.append_log import AppendLog
+from libs.sstable import KEY_SIZE, SSTableReader, SSTableWriter, TextSegmentReader, decode_record, encode_record, open_segment
+from libs.compaction import CompactionPolicy, Compactor, RateLimiter
+from libs.block_cache import BlockCache
+from libs.blob_log import BlobLog, BlobRef
+from libs.compression import Codec
+from libs.manifest import Edit, Manifest
+from libs.metrics import Histogram, Registry
+
+
+# a failed flush is retried after this many seconds, doubling up to the max
+FLUSH_RETRY_BACKOFF = 0.1
+MAX_FLUSH_RETRY_BACKOFF = 5.0
+
+
+class LegacyObject(object):
+    '''Stands in for the index and filter objects pickled by older versions, which are no longer read.'''
+
+    def __init__(self, *args, **kwargs) -> None:
+        pass
+
+    def __setstate__(self, state) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> 'LegacyObject':
+        # the pickled trees also hold some of their own bound methods
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return LegacyObject()
+
+
+class LegacyStateUnpickler(pickle.Unpickler):
+    # the classes of those objects changed shape since, loading them as they were would fail
+    def find_class(self, module: str, name: str):
+        if module in ('libs.red_black_tree', 'libs.bloom_filter'):
+            return LegacyObject
+        return super().find_class(module, name)
 
 
 class LSMTree(object):
 
-    def __init__(self, segment_basename: str, segments_directory: str, wal_basename: str, threshold: int = 1000000, sparcity_factor: int = 100) -> None:
+    def __init__(
+        self,
+        segment_basename: str,
+        segments_directory: str,
+        wal_basename: str,
+        threshold: int = 1000000,
+        block_size: int = 4096,
+        block_cache_bytes: int = 8 * 1024 * 1024,
+        compression: Optional[Codec] = None,
+        blob_threshold: Optional[int] = None,
+        blob_file_bytes: int = 64 * 1024 * 1024,
+        blob_gc_ratio: float = 0.5,
+        wal_durability: str = 'batch',
+        wal_sync_interval: float = 0.05,
+        max_immutable_memtables: int = 2,
+        compaction_policy: Optional[CompactionPolicy] = None,
+        max_concurrent_compactions: int = 1,
+        compaction_bytes_per_second: Optional[int] = None,
+        manifest_checkpoint_every: int = 1000,
+        filter_rebuild_workers: int = 4,
+        metrics: Optional[Registry] = None
+    ) -> None:
         self.segments_directory: str = segments_directory
         self.wal_basename: str = wal_basename
         self.current_segment = segment_basename
-        self.segments: List[str] = []
+        self.segments: List[str] = []  # oldest to newest
+        self.levels: Dict[str, int] = {}
+        # number of the newest memtable every segment holds records of, a merged segment takes the newest of its inputs
+        self.sequences: Dict[str, int] = {}
+        self.readers: Dict[str, SSTableReader | TextSegmentReader] = {}
+        # guards segment naming and every change to the segment list
+        self.lock: RLock = RLock()
+        # Concurrency model:
+        # - writers are serialized by write_lock, so log appends and memtable inserts happen in the same order,
+        #   and they wait for their log frame to be durable after releasing it, which lets commits group up
+        # - the active memtable is the only mutable structure readers touch, probing it takes memtable_lock
+        # - immutable memtables, the segment list and segments are read lock free from snapshots, so
+        #   reads never wait on a flush or a compaction, they retry when a segment disappears under them
+        # lock order: write_lock, then lock, then memtable_lock
+        self.write_lock: Lock = Lock()
+        self.memtable_lock: Lock = Lock()
 
         self.threshold: int = threshold #  in bytes
         self.memtable: RedBlackTree = RedBlackTree()
-
-        self.index: RedBlackTree = RedBlackTree()
-        self.sparcity_factor: int = sparcity_factor
-
-        self.bf_num_items: int = 1000000
-        self.bf_false_pos_prob: int = 0.2
-        self.bloom_filter: CountingBloomFilter = CountingBloomFilter(self.bf_num_items, self.bf_false_pos_prob)
+        # full memtables waiting for the flusher, oldest to newest, with the segment each one becomes
+        self.immutable_memtables: List[Tuple[str, RedBlackTree]] = []
+        self.max_immutable_memtables: int = max_immutable_memtables
+        self.flushed: Condition = Condition(self.lock)
+        self.flush_queue: Queue = Queue()
+        self.flusher: Thread = Thread(target=self.flush_worker, name='flusher', daemon=True)
+
+        self.block_size: int = block_size  # target size of a segment data block, in bytes
+        # segments written from now on compress their blocks with it, older ones keep their own codec
+        self.compression: Codec = compression or Codec()
+
+        # values of at least blob_threshold bytes are written once to the blob log, segments only hold a reference
+        self.blob_threshold: Optional[int] = blob_threshold
+        self.blob_log: BlobLog = BlobLog(segments_directory, blob_file_bytes)
+        # bytes of every blob file no segment points at anymore, files past blob_gc_ratio get their live blobs moved by compaction
+        self.blob_garbage: Dict[int, int] = {}
+        self.blob_gc_ratio: float = blob_gc_ratio
+        # decoded blocks shared by every segment of the tree, 0 disables it
+        self.block_cache: Optional[BlockCache] = BlockCache(block_cache_bytes) if block_cache_bytes else None
+
+        # read counters of segments that were since compacted away
+        self.retired_reads: Dict[str, int] = {'bytes_read': 0, 'filter_negatives': 0}
+
+        # plain counters on the read path, they are only turned into metrics when scraped
+        self.lookups: int = 0
+        self.memtable_hits: int = 0
+        self.segments_probed: int = 0
+        self.flush_seconds: Optional[Histogram] = None
+        self.compaction_seconds: Optional[Histogram] = None
+        if metrics is not None:
+            self.register_metrics(metrics)
+
+        # every segment carries its own filter, sized from its key count at flush time
+        self.bf_false_pos_prob: float = 0.01
 
         if not (Path(segments_directory).exists() and Path(segments_directory).is_dir()):
             Path(segments_directory).mkdir(parents=True)
 
+        self.compactor: Optional[Compactor] = None
+
+        # every change to the segment list is one small edit appended here
+        self.manifest: Manifest = Manifest(segments_directory, manifest_checkpoint_every)
         if not self.load_past_state():
             self.save_state()
-        self.restore_memtable()
+        self.remove_dead_blob_files()
+        self.flusher.start()
+        self.recover_immutable_memtables()
 
-    def db_set(self, key: bytes, value: Value) -> None:
-        log = self.to_log_entry(key, value)
-        node = self.memtable.find_node(key)
-        if node:
-            self.memtable_wal().write(log)
-            node.value = value
-            return
-        
-        additional_size = len(key) + len(self.serialize_value(value))
-        if self.memtable.total_bytes + additional_size > self.threshold:
-            self.flush_memtable_to_disk(self.current_segment_path())
-            self.save_state()
-            self.memtable = RedBlackTree()
-            self.memtable_wal().clear()
+        # segments open lazily, only the ones without a usable filter get one rebuilt in the background
+        self.filter_builder: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=filter_rebuild_workers, thread_name_prefix='filter-rebuild')
+        self.rebuild_missing_filters()
 
-            self.segments.append(self.current_segment)
-            new_segment_name = self.incremented_segment_name()
-            self.current_segment = new_segment_name
-            self.memtable.total_bytes = 0
-        
-        self.memtable_wal().write(log)
+        self.wal_durability: str = wal_durability
+        self.wal_sync_interval: float = wal_sync_interval
+        legacy_wal = not AppendLog.is_binary(self.memtable_wal_path())
+        self.restore_memtable()
+        self.wal: AppendLog = AppendLog(self.memtable_wal_path(), wal_durability, wal_sync_interval)
+        if legacy_wal and self.memtable.count:
+            # rewrite a text log left by an older version in the binary format
+            self.wal.clear()
+            for node in self.memtable.in_order_traversal():
+                self.wal.write(encode_record(node.key, node.value))
 
-        self.memtable.add(key, value)
-        self.memtable.total_bytes += additional_size
+        if compaction_policy is not None:
+            self.compactor = Compactor(self, compaction_policy, max_concurrent_compactions, compaction_bytes_per_second)
+            self.compactor.start()
 
-    def db_get(self, key: bytes) -> Value:
-        node = self.memtable.find_node(key)
+    def db_set(self, key: bytes, value: Value) -> None:
+        self.db_write_batch([(key, value)])
+
+    def db_write_batch(self, items: Iterable[Tuple[bytes, Value]]) -> None:
+        # the writes of a batch share one trip through write_lock and one wait on the log
+        logs = []
+        for key, value in items:
+            if len(key) != KEY_SIZE:
+                raise ValueError(f'Keys must be {KEY_SIZE} bytes long, got {len(key)}')
+            logs.append((key, value, encode_record(key, value)))
+        if not logs:
+            return
+        with self.write_lock:
+            for key, value, log in logs:
+                # only writers change the memtable, it can be searched without memtable_lock here
+                node = self.memtable.find_node(key)
+                additional_size = len(log)
+                if not node and self.memtable.total_bytes + additional_size > self.threshold and self.memtable.count:
+                    # closing the old log waits for the writes of this batch it holds
+                    self.rotate_memtable()
+
+                wal = self.memtable_wal()
+                ticket = wal.append(log)
+                with self.memtable_lock:
+                    if node:
+                        node.value = value
+                    else:
+                        self.memtable.add(key, value)
+                        self.memtable.total_bytes += additional_size
+        # acknowledged once durable, concurrent readers may see the value a little earlier
+        wal.wait(ticket)
+
+    def db_delete(self, key: bytes) -> None:
+        # the tombstone shadows every older version of the key until compaction drops them together
+        self.db_set(key, TOMBSTONE)
+
+    def db_get(self, key: bytes) -> Optional[Value]:
+        value = self.lookup(key)
+        return None if value is TOMBSTONE else self.resolve(key, value)
+
+    def lookup(self, key: bytes) -> Optional[Value]:
+        # the newest version of the key, which may be a tombstone
+        self.lookups += 1
+        with self.memtable_lock:
+            node = self.memtable.find_node(key)
         if node:
+            self.memtable_hits += 1
             return node.value
-        if not self.bloom_filter.check(key):
-            return None
-        floor_val = self.index.floor(key)
-        floor_node = self.index.find_node(floor_val)
-
-        if floor_node:
-            path = self.segment_path(floor_node.segment)
-            with open(path, 'r') as segment_file:
-                segment_file.seek(floor_node.offset)
-                for line in segment_file:
-                    s_key, value = line.strip().split(',', 1)
-                    s_key = bytes.fromhex(s_key)
-                    if key == s_key:
-                        value = json.loads(value)
-                        value['value'] = bytes.fromhex(value['value'])
-                        return value
+        for _, memtable in reversed(self.immutable_memtables[:]):
+            node = memtable.find_node(key)
+            if node:
+                self.memtable_hits += 1
+                return node.value
         return self.search_all_segments(key)
 
+    def multi_get(self, keys: Iterable[bytes]) -> Dict[bytes, Value]:
+        values = {}
+        for key, value in self.multi_lookup(keys).items():
+            if value is not TOMBSTONE and (value := self.resolve(key, value)) is not None:
+                values[key] = value
+        return values
+
+    def multi_lookup(self, keys: Iterable[bytes]) -> Dict[bytes, Value]:
+        # sorted once so each segment is probed in bulk and each of its blocks read once per batch
+        remaining: List[bytes] = sorted(set(keys))
+        found: Dict[bytes, Value] = {}
+        self.lookups += len(remaining)
+        with self.memtable_lock:
+            remaining = self.search_memtable(self.memtable, remaining, found)
+        for _, memtable in reversed(self.immutable_memtables[:]):
+            remaining = self.search_memtable(memtable, remaining, found)
+        self.memtable_hits += len(found)
+
+        for segment in reversed(self.segments[:]):
+            if not remaining:
+                break
+            self.segments_probed += len(remaining)
+            try:
+                values = self.open_segment(segment).get_many(remaining)
+            except FileNotFoundError:
+                # compacted away mid batch, its records now live in the merged segment, a listed segment is really missing
+                if segment in self.segments:
+                    raise
+                self.lookups -= len(remaining)
+                found.update(self.multi_lookup(remaining))
+                break
+            if values:
+                found.update(values)
+                remaining = [key for key in remaining if key not in values]
+        return found
+
+    def search_memtable(self, memtable: RedBlackTree, keys: List[bytes], found: Dict[bytes, Value]) -> List[bytes]:
+        # adds the keys held by the memtable to found, returns the others
+        missing = []
+        for key in keys:
+            node = memtable.find_node(key)
+            if node:
+                found[key] = node.value
+            else:
+                missing.append(key)
+        return missing
+
+    def scan(self, start: Optional[bytes] = None, end: Optional[bytes] = None, limit: Optional[int] = None) -> Iterator[Tuple[bytes, Value]]:
+        # k-way merge of every source over [start, end), sources are ranked newest first and the newest copy wins
+        with self.memtable_lock:
+            sources = [iter([(node.key, node.value) for node in self.memtable.iter_range(start, end)])]
+        for _, memtable in reversed(self.immutable_memtables[:]):
+            sources.append((node.key, node.value) for node in memtable.iter_range(start, end))
+        try:
+            for segment in reversed(self.segments[:]):
+                sources.append(self.open_segment(segment).scan(start, end))
+        except FileNotFoundError:
+            # compacted away while the sources were gathered, nothing was yielded yet so start over
+            if segment in self.segments:
+                raise
+            yield from self.scan(start, end, limit)
+            return
+
+        def ranked(rank: int, source: Iterator[Tuple[bytes, Value]]):
+            for key, value in source:
+                yield key, rank, value
+
+        last_key: Optional[bytes] = None
+        count: int = 0
+        for key, _, value in heapq.merge(*(ranked(rank, source) for rank, source in enumerate(sources))):
+            if key == last_key:
+                continue
+            last_key = key
+            if value is TOMBSTONE:
+                continue
+            if limit is not None and count >= limit:
+                return
+            value = self.resolve(key, value)
+            if value is None:
+                continue
+            count += 1
+            yield key, value
+
+    def resolve(self, key: bytes, value: Optional[Value]) -> Optional[Value]:
+        if value is None or not isinstance(value.value, BlobRef):
+            return value
+        try:
+            return value._replace(value=self.blob_log.read(value.value))
+        except FileNotFoundError:
+            # collected since the lookup, once its last segment was compacted away, the key is read again from newer ones
+            if value.value.file not in self.blob_log.removed:
+                raise
+            self.lookups -= 1
+            value = self.lookup(key)
+            return None if value is TOMBSTONE else self.resolve(key, value)
+
+    def separate(self, value: Value) -> Value:
+        if self.blob_threshold is None or value is TOMBSTONE or isinstance(value.value, BlobRef):
+            return value
+        if len(value.value) < self.blob_threshold:
+            return value
+        return value._replace(value=self.blob_log.append(value.value))
+
+    def relocate(self, value: Value, collected: Set[int], garbage: Dict[int, int]) -> Value:
+        # live blobs of a file being collected are copied to the newest file as their segment gets rewritten
+        if value is TOMBSTONE or not isinstance(value.value, BlobRef):
+            return self.separate(value)
+        ref = value.value
+        if ref.file not in collected:
+            return value
+        garbage[ref.file] = garbage.get(ref.file, 0) + ref.length
+        return value._replace(value=self.blob_log.append(self.blob_log.read(ref)))
+
+    def count_garbage(self, value: Value, garbage: Dict[int, int]) -> None:
+        if value is not TOMBSTONE and isinstance(value.value, BlobRef):
+            ref = value.value
+            garbage[ref.file] = garbage.get(ref.file, 0) + ref.length
+
+    def collectable_blob_files(self) -> Set[int]:
+        return {
+            number for number in self.blob_log.sealed_files()
+            if self.blob_garbage.get(number, 0) >= self.blob_gc_ratio * self.blob_log.size(number)
+        }
+
+    def remove_dead_blob_files(self) -> None:
+        with self.lock:
+            for number in self.blob_log.sealed_files():
+                if self.blob_garbage.get(number, 0) >= self.blob_log.size(number):
+                    self.blob_log.remove(number)
+            existing = set(self.blob_log.file_numbers())
+            self.blob_garbage = {number: size for number, size in self.blob_garbage.items() if number in existing}
+
     def set_threshold(self, threshold: int) -> None:
         self.threshold = threshold
     
-    def set_sparcity_factor(self, factor: int) -> None:
-        self.sparcity_factor = factor
-    
     def memtable_wal(self) -> AppendLog:
-        return AppendLog.instance(self.memtable_wal_path())
+        return self.wal
 
     def search_all_segments(self, key: bytes) -> Optional[Value]:
+        # newest to oldest, a segment whose filter rejects the key costs no disk reads
         segments: List[str] = self.segments[:]
         while segments:
             segment: str = segments.pop()
-            value = self.search_segment(key, segment)
-            if value:
+            self.segments_probed += 1
+            try:
+                value = self.search_segment(key, segment)
+            except FileNotFoundError:
+                # compacted away mid search, its records now live in the merged segment
+                if segment in self.segments:
+                    raise
+                return self.search_all_segments(key)
+            if value is not None:
                 return value
 
     def search_segment(self, key: bytes, segment_name: str) -> Optional[Value]:
-        with open(self.segment_path(segment_name), 'r') as segment_file:
-            pairs = [line.strip() for line in segment_file]
-            while pairs:
-                ptr = (len(pairs) - 1) // 2
-                k, v = pairs[ptr].split(',', 1)
-
-                k = bytes.fromhex(k)
-
-                if k == key:
-                    v = json.loads(v)
-                    v['value'] = bytes.fromhex(v['value'])
-                    return v
-                
-                if key < k:
-                    pairs = pairs[:ptr]
-                else:
-                    pairs = pairs[ptr + 1:]
+        # readers check their key range and bloom filter before touching any block
+        return self.open_segment(segment_name).get(key)
+
+    def open_segment(self, segment_name: str) -> SSTableReader | TextSegmentReader:
+        # segments are immutable, so their mappings are kept open and shared
+        reader = self.readers.get(segment_name)
+        if reader is None:
+            with self.lock:
+                reader = self.readers.get(segment_name)
+                if reader is None:
+                    reader = open_segment(self.segment_path(segment_name), self.block_cache)
+                    # a segment replaced since the caller took its snapshot is served once, not kept
+                    if segment_name in self.segments:
+                        self.readers[segment_name] = reader
+        return reader
+
+    def rebuild_missing_filters(self) -> None:
+        for segment in self.segments[:]:
+            try:
+                reader = self.open_segment(segment)
+            except FileNotFoundError as e:
+                print(e)
+                continue
+            if reader.filter_missing():
+                self.filter_builder.submit(self.rebuild_filter, reader)
+
+    def rebuild_filter(self, reader: SSTableReader | TextSegmentReader) -> None:
+        try:
+            reader.rebuild_filter(self.bf_false_pos_prob)
+        except Exception as e:
+            # lookups still work without the filter, only slower
+            print(e)
+
+    def drop_segment(self, segment_name: str) -> None:
+        # lookups may still hold the reader, its mapping is released with the last reference
+        with self.lock:
+            reader = self.readers.pop(segment_name, None)
+        if reader is not None:
+            for counter in self.retired_reads:
+                self.retired_reads[counter] += getattr(reader, counter)
+
+    def read_counter(self, counter: str) -> int:
+        return self.retired_reads[counter] + sum(getattr(reader, counter) for reader in list(self.readers.values()))
+
+    def bytes_read(self) -> int:
+        return self.read_counter('bytes_read')
+
+    def register_metrics(self, metrics: Registry) -> None:
+        metrics.counter('kvdb_lookups_total', 'Point lookups, multi gets count every key', lambda: self.lookups)
+        metrics.counter('kvdb_memtable_hits_total', 'Lookups answered by the active or an immutable memtable', lambda: self.memtable_hits)
+        metrics.counter('kvdb_segments_probed_total', 'Segments consulted by lookups that missed the memtables', lambda: self.segments_probed)
+        metrics.counter('kvdb_filter_negatives_total', 'Segment probes the bloom filter answered without reading a block', lambda: self.read_counter('filter_negatives'))
+        metrics.counter('kvdb_segment_bytes_read_total', 'Stored block bytes read by lookups', self.bytes_read)
+        metrics.gauge('kvdb_memtable_bytes', 'Encoded bytes held by the active memtable', lambda: self.memtable.total_bytes)
+        metrics.gauge('kvdb_immutable_memtables', 'Full memtables waiting to be flushed', lambda: len(self.immutable_memtables))
+        metrics.gauge('kvdb_segments', 'Live segments', lambda: len(self.segments))
+        if self.block_cache is not None:
+            metrics.counter('kvdb_cache_hits_total', 'Cache hits', lambda: self.block_cache.hits, cache='block')
+            metrics.counter('kvdb_cache_misses_total', 'Cache misses', lambda: self.block_cache.misses, cache='block')
+            metrics.gauge('kvdb_cache_bytes', 'Bytes held by the cache', lambda: self.block_cache.used_bytes, cache='block')
+        self.flush_seconds = metrics.histogram('kvdb_flush_seconds', 'Time to write a memtable to a segment')
+        self.compaction_seconds = metrics.histogram('kvdb_compaction_seconds', 'Time to merge a run of segments')
     
-    def load_past_state(self):
-        if Path(self.past_state_path()).exists():
+    def load_past_state(self) -> bool:
+        if self.manifest.exists():
+            for edit in self.manifest.replay():
+                self.apply_edit(edit)
+            self.manifest.open()
+            return True
+        elif Path(self.past_state_path()).exists():
+            # pickled state left by an older version, checkpointed into a manifest and dropped
             with open(self.past_state_path(), 'rb') as state_file:
-                state = pickle.load(state_file)
+                state = LegacyStateUnpickler(state_file).load()
                 self.segments = state['segments']
                 self.current_segment = state['current_segment']
-                self.bloom_filter = state['bloom_filter']
-                self.bf_num_items = state['bf_num_items']
                 self.bf_false_pos_prob = state['bf_false_pos_prob']
-                self.index = state['index']
+                self.levels = state.get('levels', {})
+            if self.current_segment not in self.segments and Path(self.segment_path(self.current_segment)).exists():
+                # older versions saved their state before listing the segment they had just flushed
+                self.segments.append(self.current_segment)
+                self.current_segment = self.incremented_segment_name()
+            self.save_state()
+            remove_file(self.past_state_path())
             return True
         else:
             return False
-    
-    def save_state(self):
-        state = {
-            'current_segment': self.current_segment,
-            'segments': self.segments,
-            'bloom_filter': self.bloom_filter,
-            'bf_num_items': self.bf_num_items,
-            'bf_false_pos_prob': self.bf_false_pos_prob,
-            'index': self.index
-        }
 
-        with open(self.past_state_path(), 'wb') as state_file:
-            pickle.dump(state, state_file)
+    def save_state(self) -> None:
+        # a checkpoint, replaying the manifest starts from this snapshot
+        with self.lock:
+            self.manifest.checkpoint({
+                'edit': 'snapshot',
+                'current_segment': self.current_segment,
+                'segments': self.segments,
+                'levels': self.levels,
+                'sequences': self.sequences,
+                'bf_false_pos_prob': self.bf_false_pos_prob,
+                'blob_garbage': self.blob_garbage
+            })
+
+    def log_edit(self, edit: Edit) -> None:
+        # the edit is durable before the tree acts on it
+        with self.lock:
+            self.manifest.append(edit)
+            self.apply_edit(edit)
+            if self.manifest.needs_checkpoint():
+                self.save_state()
+
+    def apply_edit(self, edit: Edit) -> None:
+        match edit['edit']:
+            case 'snapshot':
+                self.current_segment = edit['current_segment']
+                self.segments = list(edit['segments'])
+                self.levels = dict(edit['levels'])
+                self.sequences = dict(edit.get('sequences', {}))
+                self.bf_false_pos_prob = edit['bf_false_pos_prob']
+                self.blob_garbage = {int(number): size for number, size in edit.get('blob_garbage', {}).items()}
+            case 'next_segment':
+                self.current_segment = edit['current_segment']
+            case 'add_segment':
+                # segments stay ordered by age, a memtable recovered after a newer one was flushed goes before it
+                sequence = self.segment_sequence(edit['segment'])
+                position = next(
+                    (position for position, segment in enumerate(self.segments) if self.segment_sequence(segment) > sequence),
+                    len(self.segments)
+                )
+                self.segments.insert(position, edit['segment'])
+                self.levels[edit['segment']] = edit['level']
+                self.sequences[edit['segment']] = sequence
+            case 'replace_segments':
+                old_segments = edit['old_segments']
+                start = self.segments.index(old_segments[0])
+                self.segments[start:start + len(old_segments)] = [edit['segment']]
+                self.sequences[edit['segment']] = max(self.segment_sequence(segment) for segment in old_segments)
+                for segment in old_segments:
+                    self.levels.pop(segment, None)
+                    self.sequences.pop(segment, None)
+                self.levels[edit['segment']] = edit['level']
+                for number, size in edit.get('blob_garbage', {}).items():
+                    self.blob_garbage[int(number)] = self.blob_garbage.get(int(number), 0) + size
+            case 'settings':
+                self.bf_false_pos_prob = edit['bf_false_pos_prob']
+            case _:
+                raise Exception(f'Unknown manifest edit {edit}!')
     
+    def segment_sequence(self, segment: str) -> int:
+        # segments flushed before sequences were recorded are ordered by the number in their name
+        sequence = self.sequences.get(segment)
+        return sequence if sequence is not None else int(segment.split('-')[1])
+
+    def replay_wal(self, path: str, memtable: RedBlackTree) -> None:
+        for record in AppendLog.replay(path):
+            key, value, _ = decode_record(record, 0)
+            memtable.add(key, value)
+            memtable.total_bytes += len(record)
+
     def restore_memtable(self):
-        if Path(self.memtable_wal_path()).exists():
+        if AppendLog.is_binary(self.memtable_wal_path()):
+            self.replay_wal(self.memtable_wal_path(), self.memtable)
+        elif Path(self.memtable_wal_path()).exists():
             with open(self.memtable_wal_path(), 'r') as memtable_file:
                 for line in memtable_file:
                     key, value = line.strip().split(',', 1)
                     key = bytes.fromhex(key)
-                    value = json.loads(value)
-                    value['value'] = bytes.fromhex(value['value'])
+                    value = Record.from_json(json.loads(value))
                     self.memtable.add(key, value)
                     self.memtable.total_bytes += len(line)
     
-    def flush_memtable_to_disk(self, path: str):
-        sparcity_counter = self.sparcity()
-
-        key_offset: int = 0
-
-        with open(path, 'w') as file:
-            for node in self.memtable.in_order_traversal():
-                log = self.to_log_entry(node.key, node.value)
-
-                if sparcity_counter == 1:
-                    # Do not store value in an index!!!!!!!!
-                    self.index.add(node.key, None, offset=key_offset, segment=self.current_segment)
-                    sparcity_counter = self.sparcity() + 1
-        
-                self.bloom_filter.add(node.key)
-                file.write(log)
-                key_offset += len(log)
-                sparcity_counter -= 1
+    def recover_immutable_memtables(self) -> None:
+        # logs of memtables that were handed off but never made it to a segment
+        frozen = []
+        for path in Path(self.segments_directory).glob(f'{self.wal_basename}.*'):
+            segment = path.name[len(self.wal_basename) + 1:]
+            if segment in self.segments:
+                remove_file(path)
+            else:
+                frozen.append(segment)
+
+        for segment in sorted(frozen, key=lambda name: int(name.split('-')[1])):
+            memtable = RedBlackTree()
+            self.replay_wal(self.frozen_wal_path(segment), memtable)
+            if segment == self.current_segment:
+                self.log_edit({'edit': 'next_segment', 'current_segment': self.incremented_segment_name()})
+            self.immutable_memtables.append((segment, memtable))
+            self.flush_queue.put((segment, memtable))
+
+    def rotate_memtable(self) -> None:
+        # the full memtable stays readable while the flusher writes it, writes move on to a fresh one
+        with self.flushed:
+            while len(self.immutable_memtables) >= self.max_immutable_memtables:
+                self.flushed.wait()
+
+            segment = self.current_segment
+            memtable = self.memtable
+            self.log_edit({'edit': 'next_segment', 'current_segment': self.incremented_segment_name()})
+
+            self.wal.close()
+            rename_file(self.memtable_wal_path(), self.frozen_wal_path(segment))
+            self.wal = AppendLog(self.memtable_wal_path(), self.wal_durability, self.wal_sync_interval)
+
+            self.immutable_memtables = self.immutable_memtables + [(segment, memtable)]
+            self.memtable = RedBlackTree()
+        self.flush_queue.put((segment, memtable))
+
+    def flush_worker(self) -> None:
+        while True:
+            job = self.flush_queue.get()
+            try:
+                if job is None:
+                    return
+                self.flush_until_done(*job)
+            finally:
+                self.flush_queue.task_done()
+
+    def flush_until_done(self, segment: str, memtable: RedBlackTree) -> None:
+        # newer memtables wait, one flushed first would end up in front of the older one it shadows
+        backoff = FLUSH_RETRY_BACKOFF
+        while True:
+            try:
+                return self.flush_immutable_memtable(segment, memtable)
+            except Exception as e:
+                # the memtable stays readable meanwhile and its log is replayed on the next start
+                print(e)
+                sleep(backoff)
+                backoff = min(backoff * 2, MAX_FLUSH_RETRY_BACKOFF)
+
+    def flush_immutable_memtable(self, segment: str, memtable: RedBlackTree) -> None:
+        start = perf_counter()
+        # a retry after the segment was added only has the log left to remove
+        if segment not in self.segments:
+            self.flush_memtable_to_disk(memtable, self.segment_path(segment))
+            with self.flushed:
+                self.log_edit({'edit': 'add_segment', 'segment': segment, 'level': 0})
+        with self.flushed:
+            self.immutable_memtables = [(name, table) for name, table in self.immutable_memtables if name != segment]
+            self.flushed.notify_all()
+        if Path(self.frozen_wal_path(segment)).exists():
+            remove_file(self.frozen_wal_path(segment))
+        if self.flush_seconds is not None:
+            self.flush_seconds.observe(perf_counter() - start)
+        if self.compactor:
+            self.compactor.notify()
+
+    def flush(self) -> None:
+        with self.write_lock:
+            if self.memtable.count:
+                self.rotate_memtable()
+        self.flush_queue.join()
+
+    def flush_memtable_to_disk(self, memtable: RedBlackTree, path: str):
+        temp_path = f'{path}.tmp'
+        with SSTableWriter(temp_path, self.block_size, self.bf_false_pos_prob, self.compression) as writer:
+            for node in memtable.in_order_traversal():
+                writer.add(node.key, self.separate(node.value))
+        self.blob_log.sync()
+        rename_file(temp_path, path)
     
     def serialize_value(self, value: Value) -> str:
-        j_value = deepcopy(value)
-        j_value['value'] = value['value'].hex()
-        return str(json.dumps(j_value))
-
-    def to_log_entry(self, key: bytes, value: Value) -> str:
-        return f'{key.hex()}, {self.serialize_value(value)}\n'
+        return json.dumps(value.to_json())
 
     def incremented_segment_name(self) -> str:
         name, number = self.current_segment.split('-')
@@ -193,65 +642,99 @@ class LSMTree(object):
 
         return f'{name}-{new_number}'
 
-    def merge(self, segment_a, segment_b) -> None:
-        path_a = Path.joinpath(Path(self.segments_directory), segment_a)
-        path_b = Path.joinpath(Path(self.segments_directory), segment_b)
-        new_path = Path.joinpath(Path(self.segments_directory), 'temp')
-
-        with open(new_path, 'w') as temp:
-            with open(path_a, 'r') as file_a:
-                with open(path_b, 'r') as file_b:
-                    line_a, line_b = file_a.readline(), file_b.readline()
-                    while line_a != '' or line_b != '':
-                        key_a = bytes.fromhex(line_a.strip().split(',', 1)[0])
-                        key_b = bytes.fromhex(line_b.strip().split(',', 1)[0])
-                        if key_a == '' or key_b == key_a:
-                            temp.write(line_b)
-                            line_a, line_b = file_a.readline(), file_b.readline()
-                        elif key_b == '' or key_a < key_b:
-                            temp.write(line_a)
-                            line_a = file_a.readline()
-                        else:
-                            temp.write(line_b)
-                            line_b = file_b.readline()
-        
-        remove_file(path_a)
-        remove_file(path_b)
-        rename_file(new_path, path_a)
-
-        return segment_a
+    def merge(
+        self,
+        *segments: str,
+        rate_limiter: Optional[RateLimiter] = None,
+        drop_tombstones: bool = False,
+        blob_garbage: Optional[Dict[int, int]] = None
+    ) -> str:
+        # segments go from oldest to newest, the newest copy of every key wins and shadowed ones are dropped
+        # blob bytes no longer referenced by the output are added to blob_garbage
+        garbage: Dict[int, int] = {} if blob_garbage is None else blob_garbage
+        with self.lock:
+            new_segment = self.current_segment
+            self.log_edit({'edit': 'next_segment', 'current_segment': self.incremented_segment_name()})
+            collected = self.collectable_blob_files()
+        temp_path = self.segment_path(f'{new_segment}.tmp')
+
+        def tagged(age: int, reader):
+            for key, value in reader:
+                yield key, age, value
+
+        readers = [self.open_segment(segment) for segment in segments]
+        merged = heapq.merge(*(tagged(-age, reader) for age, reader in enumerate(readers)))
+
+        last_key: Optional[bytes] = None
+        written: int = 0
+        with SSTableWriter(temp_path, self.block_size, self.bf_false_pos_prob, self.compression) as writer:
+            for key, _, value in merged:
+                if key == last_key:
+                    self.count_garbage(value, garbage)
+                    continue
+                last_key = key
+                if drop_tombstones and value is TOMBSTONE:
+                    continue
+                writer.add(key, self.relocate(value, collected, garbage))
+                if rate_limiter and writer.offset > written:
+                    rate_limiter.consume(writer.offset - written)
+                    written = writer.offset
+
+        self.blob_log.sync()
+        rename_file(temp_path, self.segment_path(new_segment))
+        return new_segment
+
+    def compact(self, segments: List[str], level: int = 0, rate_limiter: Optional[RateLimiter] = None) -> str:
+        # nothing older than a run starting at the oldest segment can be shadowed, its tombstones have done their job
+        start = perf_counter()
+        with self.lock:
+            bottom = self.segments[0] == segments[0]
+        blob_garbage: Dict[int, int] = {}
+        new_segment = self.merge(*segments, rate_limiter=rate_limiter, drop_tombstones=bottom, blob_garbage=blob_garbage)
+        self.replace_segments(segments, new_segment, level, blob_garbage)
+        if self.compaction_seconds is not None:
+            self.compaction_seconds.observe(perf_counter() - start)
+        return new_segment
+
+    def replace_segments(self, old_segments: List[str], new_segment: str, level: int, blob_garbage: Optional[Dict[int, int]] = None) -> None:
+        with self.lock:
+            start = self.segments.index(old_segments[0])
+            if self.segments[start:start + len(old_segments)] != old_segments:
+                raise Exception(f'Segments {old_segments} are not a contiguous run!')
+            self.log_edit({
+                'edit': 'replace_segments',
+                'old_segments': old_segments,
+                'segment': new_segment,
+                'level': level,
+                'blob_garbage': blob_garbage or {}
+            })
+
+        for segment in old_segments:
+            remove_file(self.segment_path(segment))
+            self.drop_segment(segment)
+        if blob_garbage:
+            self.remove_dead_blob_files()
+
+    def close(self) -> None:
+        self.flush_queue.join()
+        if self.compactor:
+            self.compactor.stop()
+        self.flush_queue.put(None)
+        self.flusher.join()
+        self.filter_builder.shutdown(wait=True, cancel_futures=True)
+        self.wal.close()
+        self.blob_log.close()
+        self.manifest.close()
 
     def get_file_size(self, path: str) -> int:
         return Path(path).stat().st_size
-    
-    def sparcity(self) -> int:
-        return self.threshold // self.sparcity_factor
-    
-    def repopulate_index(self) -> None:
-        self.index = RedBlackTree()
-        for segment in self.segments:
-            path = self.segment_path(segment)
-            counter = self.sparcity()
-            n_bytes: int = 0
-            with open(path, 'r') as segment_file:
-                for line in segment_file:
-                    key, value = line.strip().split(',', 1)
-                    key = bytes.fromhex(key)
-                    value = json.loads(value)
-                    value['value'] = bytes.fromhex(value['value'])
-                    if counter == 1:
-                        self.index.add(key, None, offset=bytes, segment=segment)
-                        counter = self.sparcity() + 1
-                    n_bytes += len(line)
-                    counter -= 1
-    
-    def set_bloom_filter_num_items(self, num_items: int) -> None:
-        self.bf_num_items = num_items
-        self.bloom_filter = CountingBloomFilter(self.bf_num_items, self.bf_false_pos_prob)
 
-    def set_bloom_filter_false_pos_prob(self, false_pos_prob: int) -> None:
-        self.bf_false_pos_prob = false_pos_prob
-        self.bloom_filter = CountingBloomFilter(self.bf_num_items, self.bf_false_pos_prob)
+    def segment_size(self, segment_name: str) -> int:
+        return self.get_file_size(self.segment_path(segment_name))
+    
+    def set_bloom_filter_false_pos_prob(self, false_pos_prob: float) -> None:
+        # only affects segments written from now on
+        self.log_edit({'edit': 'settings', 'bf_false_pos_prob': false_pos_prob})
 
     def current_segment_path(self) -> str:
         return Path.joinpath(Path(self.segments_directory), self.current_segment)
@@ -259,6 +742,9 @@ class LSMTree(object):
     def memtable_wal_path(self) -> str:
         return Path.joinpath(Path(self.segments_directory), self.wal_basename)
 
+    def frozen_wal_path(self, segment_name: str) -> str:
+        return Path.joinpath(Path(self.segments_directory), f'{self.wal_basename}.{segment_name}')
+
     def segment_path(self, segment_name: str) -> str:
         return Path.joinpath(Path(self.segments_directory), segment_name)
     
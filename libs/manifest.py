@@ -0,0 +1,90 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+from libs.append_log import AppendLog
+
+
+# The tree state is a log of version edits framed like the WAL. A manifest file
+# starts with a snapshot edit, CURRENT names the manifest to replay on startup.
+CURRENT = 'CURRENT'
+MANIFEST_PREFIX = 'MANIFEST-'
+
+Edit = Dict[str, Any]
+
+
+class Manifest(object):
+    '''Append only log of the edits made to the segment list, checkpointed into a fresh file now and then.'''
+
+    def __init__(self, directory: str, checkpoint_every: int = 1000) -> None:
+        self.directory: Path = Path(directory)
+        self.checkpoint_every: int = checkpoint_every
+        self.number: int = 0
+        self.log: Optional[AppendLog] = None
+        self.edits_since_checkpoint: int = 0
+        if self.exists():
+            self.number = int(self.current_path().read_text().strip()[len(MANIFEST_PREFIX):])
+
+    def exists(self) -> bool:
+        return self.current_path().exists()
+
+    def replay(self) -> Iterator[Edit]:
+        # a torn last edit never reached the disk as far as the tree is concerned
+        self.edits_since_checkpoint = 0
+        for payload in AppendLog.replay(self.manifest_path(self.number)):
+            self.edits_since_checkpoint += 1
+            yield json.loads(payload)
+
+    def open(self) -> None:
+        self.log = AppendLog(self.manifest_path(self.number), 'batch')
+
+    def append(self, edit: Edit) -> None:
+        self.log.write(json.dumps(edit).encode())
+        self.edits_since_checkpoint += 1
+
+    def needs_checkpoint(self) -> bool:
+        return self.edits_since_checkpoint >= self.checkpoint_every
+
+    def checkpoint(self, snapshot: Edit) -> None:
+        # the snapshot goes to a new file, CURRENT is swapped atomically and only then is the old file removed
+        number = self.number + 1
+        path = self.manifest_path(number)
+        if path.exists():
+            path.unlink()  # left by a checkpoint that crashed before CURRENT moved
+        log = AppendLog(path, 'batch')
+        log.write(json.dumps(snapshot).encode())
+
+        temp_path = self.directory / f'{CURRENT}.tmp'
+        with open(temp_path, 'w') as current_file:
+            current_file.write(f'{path.name}\n')
+            current_file.flush()
+            os.fsync(current_file.fileno())
+        os.rename(temp_path, self.current_path())
+        self.sync_directory()
+
+        old_log, old_number = self.log, self.number
+        self.log, self.number = log, number
+        self.edits_since_checkpoint = 1
+        if old_log:
+            old_log.close()
+        if old_number and self.manifest_path(old_number).exists():
+            self.manifest_path(old_number).unlink()
+
+    def sync_directory(self) -> None:
+        descriptor = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def close(self) -> None:
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def current_path(self) -> Path:
+        return self.directory / CURRENT
+
+    def manifest_path(self, number: int) -> Path:
+        return self.directory / f'{MANIFEST_PREFIX}{number:06d}'
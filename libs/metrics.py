@@ -0,0 +1,165 @@
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Prometheus text exposition format, version 0.0.4
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# from 10us to 10s, most storage operations land in the lower half
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, bool):
+        return str(int(value))
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    type: str = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Labels = ()) -> None:
+        self.name: str = name
+        self.help: str = help
+        self.labels: Labels = labels
+
+    def samples(self) -> Iterator[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    '''Monotonic count, either kept here or read from `function` when scraped.'''
+
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), function: Optional[Callable[[], float]] = None) -> None:
+        super().__init__(name, help, labels)
+        self.function: Optional[Callable[[], float]] = function
+        self.value: float = 0
+        self.lock: Lock = Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, self.labels, self.function() if self.function else self.value
+
+
+class Gauge(Counter):
+    '''Current value, either set here or read from `function` when scraped.'''
+
+    type = 'gauge'
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Labels = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets: List[float] = sorted(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum: float = 0.0
+        self.lock: Lock = Lock()
+
+    def observe(self, value: float) -> None:
+        position = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    def time(self) -> 'Timer':
+        return Timer(self)
+
+    def samples(self) -> Iterator[Sample]:
+        with self.lock:
+            counts, total = self.counts[:], self.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + [float('inf')], counts):
+            cumulative += count
+            yield f'{self.name}_bucket', self.labels + (('le', format_value(bound)),), cumulative
+        yield f'{self.name}_sum', self.labels, total
+        yield f'{self.name}_count', self.labels, cumulative
+
+
+class Timer(object):
+    '''Observes how long its `with` block took, cheaper than a generator based context manager.'''
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: Histogram) -> None:
+        self.histogram: Histogram = histogram
+        self.start: float = 0.0
+
+    def __enter__(self) -> 'Timer':
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Registry(object):
+    '''Metrics of one process, a metric is identified by its name and labels.'''
+
+    def __init__(self) -> None:
+        self.metrics: Dict[Tuple[str, Labels], Metric] = {}
+        self.lock: Lock = Lock()
+
+    def register(self, kind: type, name: str, help: str, labels: Dict[str, str], **options) -> Metric:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = kind(name, help, key[1], **options)
+                self.metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, help: str, function: Optional[Callable[[], float]] = None, **labels: str) -> Counter:
+        return self.register(Counter, name, help, labels, function=function)
+
+    def gauge(self, name: str, help: str, function: Optional[Callable[[], float]] = None, **labels: str) -> Gauge:
+        return self.register(Gauge, name, help, labels, function=function)
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS, **labels: str) -> Histogram:
+        return self.register(Histogram, name, help, labels, buckets=buckets)
+
+    def expose(self) -> str:
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: (metric.name, metric.labels))
+        lines: List[str] = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f'# HELP {metric.name} {metric.help}')
+                lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
@@ -2,9 +2,9 @@
 
 from collections import deque
 from enum import Enum
-from typing import Callable, Deque, Dict, List, Optional, Tuple
-# from .types import Value
-Value = Dict[str, bytes | str]
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from libs.types import Value
 
 
 class Colors(Enum):
@@ -19,6 +19,9 @@ class Directions(Enum):
 
 
 class Node(object):
+    # one node per key in every memtable, slots keep it to the six references it needs
+    __slots__ = ('key', 'color', 'parent', 'left', 'right', 'value')
+
     def __init__(
         self,
         key: bytes,
@@ -26,9 +29,7 @@ class Node(object):
         parent: 'Node',
         left: 'Node' = None,
         right: 'Node' = None,
-        value: Value = None,
-        offset: int = None,
-        segment: int = None
+        value: Value = None
     ) -> None:
         self.key: bytes = key
         self.color: Colors = color
@@ -36,8 +37,6 @@ class Node(object):
         self.left: 'Node' = left
         self.right: 'Node' = right
         self.value: Value = value
-        self.offset: int = offset
-        self.segment: int = segment
 
     def __iter__(self):
         if self.left.color != Colors.NIL:
@@ -49,7 +48,7 @@ class Node(object):
             yield from iter(self.right)
 
     def __repr__(self) -> str:
-        return f'Node({self.color}, {self.key}, {self.value}, {self.offset}, {self.segment})'
+        return f'Node({self.color}, {self.key}, {self.value})'
 
     def __eq__(self, __o: object) -> bool:
         if isinstance(__o, self.__class__):
@@ -68,13 +67,6 @@ class Node(object):
     def get_children_count(self) -> bool:
         return int(self.left.color != Colors.NIL) + int(self.right.color != Colors.NIL)
 
-    def in_order_traversal(self, traversal: List['Node']):
-        if self.left.color != Colors.NIL:
-            self.left.in_order_traversal(traversal)
-        traversal.append(self)
-        if self.right.color != Colors.NIL:
-            self.right.in_order_traversal(traversal)
-
 
 class RedBlackTree(object):
     NIL_LEAF = Node(key=None, color=Colors.NIL, parent=None, value=None)
@@ -93,7 +85,7 @@ class RedBlackTree(object):
             return list()
         yield from iter(self.root)
 
-    def add(self, key: bytes, value: Value, offset: int = None, segment: int = None) -> None:
+    def add(self, key: bytes, value: Value) -> None:
         if not self.root:
             self.root = Node(
                 key=key,
@@ -101,9 +93,7 @@ class RedBlackTree(object):
                 parent=None,
                 left=self.NIL_LEAF,
                 right=self.NIL_LEAF,
-                value=value,
-                offset=offset,
-                segment=segment
+                value=value
             )
             self.count += 1
             return
@@ -118,9 +108,7 @@ class RedBlackTree(object):
             parent=parent,
             left=self.NIL_LEAF,
             right=self.NIL_LEAF,
-            value=value,
-            offset=offset,
-            segment=segment
+            value=value
         )
 
         if node_dir == Directions.L:
@@ -346,7 +334,7 @@ class RedBlackTree(object):
     def _right_rotation(self, node: Node, parent: Node, grandfather: Node, to_recolor=False) -> None:
         grand_grandfather: Node = grandfather.parent
         self.__update_parent(
-            node=parent, parent_old_child=grand_grandfather, new_parent=grand_grandfather)
+            node=parent, parent_old_child=grandfather, new_parent=grand_grandfather)
 
         old_right: Node = parent.right
         parent.right = grandfather
@@ -458,8 +446,24 @@ class RedBlackTree(object):
             direction: Directions = Directions.R
         return sibling, direction
 
-    def in_order_traversal(self) -> List[Node]:
-        traversal: List[Node] = []
-        if self.root:
-            self.root.in_order_traversal(traversal)
-        return traversal
+    def in_order_traversal(self) -> Iterator[Node]:
+        return self.iter_range()
+
+    def iter_range(self, start: Optional[bytes] = None, end: Optional[bytes] = None) -> Iterator[Node]:
+        # in order walk over the keys in [start, end) that never builds the whole list
+        stack: List[Node] = []
+        node: Optional[Node] = self.root
+        while True:
+            while node is not None and node.color != Colors.NIL:
+                if start is not None and node.key < start:
+                    node = node.right
+                else:
+                    stack.append(node)
+                    node = node.left
+            if not stack:
+                return
+            node = stack.pop()
+            if end is not None and node.key >= end:
+                return
+            yield node
+            node = node.right
@@ -0,0 +1,546 @@
+from array import array
+import json
+import mmap
+import struct
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+from libs.blob_log import BlobRef
+from libs.block_cache import BlockCache
+from libs.bloom_filter import HASH_SCHEME, BloomFilter
+from libs.compression import Codec, get_codec
+from libs.types import TOMBSTONE, Record, Value
+
+
+# Binary segment layout (version 1):
+#
+#   [data block 0] ... [data block n] [index] [bloom filter] [meta] [trailer]
+#
+# A data block is a run of records sorted by key. Each record is a fixed
+# header followed by the content type, the encoding and the raw value.
+# The index holds one fence pointer (first key, offset, length) per block,
+# the bloom filter is sized from the number of keys in the segment, meta is
+# a small json document describing both and the trailer tells where the
+# index and meta start. A deleted key is a record with the tombstone flag
+# set and no value, a value kept in the blob log is a record with the blob
+# flag set and a blob reference in place of the value. Blocks may be compressed as a whole, the index then
+# points at the compressed bytes and meta names the codec.
+MAGIC = b'YSST'
+VERSION = 1
+KEY_SIZE = 16
+
+RECORD_HEADER = struct.Struct('<16sBHHI')  # key, flags, content type len, encoding len, value len
+INDEX_ENTRY = struct.Struct('<16sQI')  # first key, block offset, block length
+TRAILER = struct.Struct('<QIIH4s')  # index offset, index length, meta length, version, magic
+
+FLAG_TOMBSTONE = 0x01
+FLAG_BLOB = 0x02
+
+# below this many keys, probing the bloom filter one key at a time beats a numpy batch
+BULK_FILTER_MIN_KEYS = 32
+
+# rough per record cost of a decoded block on top of its raw bytes, used to charge the block cache
+DECODED_RECORD_OVERHEAD = 200
+
+
+class IndexEntry(NamedTuple):
+    '''Fence pointer of a data block.'''
+
+    first_key: bytes
+    offset: int
+    length: int
+
+
+def encode_record(key: bytes, value: Value) -> bytes:
+    if value is TOMBSTONE:
+        return RECORD_HEADER.pack(key, FLAG_TOMBSTONE, 0, 0, 0)
+    content_type = value.content_type.encode()
+    encoding = value.encoding.encode()
+    raw = value.value
+    flags = 0
+    if isinstance(raw, BlobRef):
+        raw = raw.pack()
+        flags = FLAG_BLOB
+    return b''.join((
+        RECORD_HEADER.pack(key, flags, len(content_type), len(encoding), len(raw)),
+        content_type,
+        encoding,
+        raw
+    ))
+
+
+def decode_record(buffer: bytes, pos: int) -> Tuple[bytes, Value, int]:
+    key, flags, ct_len, enc_len, value_len = RECORD_HEADER.unpack_from(buffer, pos)
+    pos += RECORD_HEADER.size
+    if flags & FLAG_TOMBSTONE:
+        return key, TOMBSTONE, pos
+    content_type = bytes(buffer[pos:pos + ct_len]).decode()
+    pos += ct_len
+    encoding = bytes(buffer[pos:pos + enc_len]).decode()
+    pos += enc_len
+    value = bytes(buffer[pos:pos + value_len])
+    pos += value_len
+    if flags & FLAG_BLOB:
+        value = BlobRef.unpack(value)
+    return key, Record(content_type, encoding, value), pos
+
+
+def skip_record(buffer: bytes, pos: int) -> Tuple[bytes, int]:
+    key, _, ct_len, enc_len, value_len = RECORD_HEADER.unpack_from(buffer, pos)
+    return key, pos + RECORD_HEADER.size + ct_len + enc_len + value_len
+
+
+class SSTableWriter(object):
+
+    def __init__(self, path: str, block_size: int = 4096, false_positive_prob: float = 0.01, codec: Optional[Codec] = None) -> None:
+        self.path: str = path
+        self.block_size: int = block_size
+        self.false_positive_prob: float = false_positive_prob
+        self.codec: Codec = codec or Codec()
+        self.raw_bytes: int = 0
+        self.file = open(path, 'wb')
+        self.offset: int = 0
+        self.block: bytearray = bytearray()
+        self.block_first_key: Optional[bytes] = None
+        self.index: List[IndexEntry] = []
+        self.keys: List[bytes] = []
+        self.count: int = 0
+        self.tombstones: int = 0
+        self.min_key: Optional[bytes] = None
+        self.max_key: Optional[bytes] = None
+
+    def __enter__(self) -> 'SSTableWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.finish()
+        else:
+            self.file.close()
+
+    def add(self, key: bytes, value: Value) -> None:
+        if len(key) != KEY_SIZE:
+            raise ValueError(f'Keys must be {KEY_SIZE} bytes long, got {len(key)}')
+        if self.max_key is not None and key <= self.max_key:
+            raise ValueError('Keys must be added in strictly ascending order')
+
+        if self.block_first_key is None:
+            self.block_first_key = key
+        self.block += encode_record(key, value)
+        self.keys.append(key)
+
+        if self.min_key is None:
+            self.min_key = key
+        self.max_key = key
+        self.count += 1
+        if value is TOMBSTONE:
+            self.tombstones += 1
+
+        if len(self.block) >= self.block_size:
+            self.flush_block()
+
+    def flush_block(self) -> None:
+        if not self.block:
+            return
+        stored = self.codec.compress(bytes(self.block))
+        self.file.write(stored)
+        self.index.append(IndexEntry(self.block_first_key, self.offset, len(stored)))
+        self.raw_bytes += len(self.block)
+        self.offset += len(stored)
+        self.block = bytearray()
+        self.block_first_key = None
+
+    def finish(self) -> None:
+        self.flush_block()
+
+        index = b''.join(INDEX_ENTRY.pack(*entry) for entry in self.index)
+
+        bloom_filter = BloomFilter(self.count, self.false_positive_prob)
+        bloom_filter.add_many(self.keys)
+        bloom_bytes = bloom_filter.to_bytes()
+
+        meta = json.dumps({
+            'count': self.count,
+            'tombstones': self.tombstones,
+            'block_size': self.block_size,
+            'min_key': self.min_key.hex() if self.min_key else None,
+            'max_key': self.max_key.hex() if self.max_key else None,
+            'bloom_filter': {
+                'offset': self.offset + len(index),
+                'length': len(bloom_bytes),
+                'bit_array_size': bloom_filter.bit_array_size,
+                'num_hash_fns': bloom_filter.num_hash_fns,
+                'false_positive_prob': bloom_filter.false_positive_prob,
+                'hash': HASH_SCHEME
+            },
+            'compression': {
+                'codec': self.codec.name,
+                'level': self.codec.level,
+                'raw_bytes': self.raw_bytes,
+                'stored_bytes': self.offset,
+                'ratio': round(self.raw_bytes / self.offset, 3) if self.offset else 1.0
+            }
+        }).encode()
+
+        self.file.write(index)
+        self.file.write(bloom_bytes)
+        self.file.write(meta)
+        self.file.write(TRAILER.pack(self.offset, len(index), len(meta), VERSION, MAGIC))
+        self.file.close()
+
+
+def map_file(path: str) -> Optional[mmap.mmap]:
+    with open(path, 'rb') as file:
+        if file.seek(0, 2) == 0:
+            return None  # empty files cannot be mapped
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class SSTableReader(object):
+
+    def __init__(self, path: str, cache: Optional[BlockCache] = None) -> None:
+        self.path: str = path
+        self.cache: Optional[BlockCache] = cache
+        self.data: mmap.mmap = map_file(path)
+
+        trailer_offset = len(self.data) - TRAILER.size
+        index_offset, index_length, meta_length, version, magic = TRAILER.unpack_from(self.data, trailer_offset)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} segment')
+        meta_offset = trailer_offset - meta_length
+        self.meta: dict = json.loads(self.data[meta_offset:trailer_offset])
+        self.min_key: Optional[bytes] = bytes.fromhex(self.meta['min_key']) if self.meta['min_key'] else None
+        self.max_key: Optional[bytes] = bytes.fromhex(self.meta['max_key']) if self.meta['max_key'] else None
+        compression = self.meta.get('compression', {})
+        self.codec: Codec = get_codec(compression.get('codec', 'none'), compression.get('level'))
+        self.compression_ratio: float = compression.get('ratio', 1.0)
+
+        # opening a segment only parses its footer, the index and filter are read on first touch
+        self.index_offset: int = index_offset
+        self.index_length: int = index_length
+        self.loaded: bool = False
+        self.load_lock: Lock = Lock()
+        self.bloom_filter: Optional[BloomFilter] = None
+        self.first_keys: List[bytes] = []
+        # stored bytes of the blocks point lookups had to read, cache hits are free
+        self.bytes_read: int = 0
+        # lookups the filter answered without reading a block
+        self.filter_negatives: int = 0
+        # the sparse index as parallel columns, the offsets and lengths packed in machine words
+        self.offsets: array = array('Q')
+        self.lengths: array = array('I')
+
+    def load(self) -> None:
+        if self.loaded:
+            return
+        with self.load_lock:
+            if self.loaded:
+                return
+            # filters built with another hashing scheme are ignored, every key is then a maybe until rebuilt
+            if self.has_stored_filter():
+                bf = self.meta['bloom_filter']
+                self.bloom_filter = BloomFilter.from_bytes(
+                    self.data[bf['offset']:bf['offset'] + bf['length']],
+                    bf['bit_array_size'],
+                    bf['num_hash_fns'],
+                    bf['false_positive_prob']
+                )
+
+            index = self.data[self.index_offset:self.index_offset + self.index_length]
+            first_keys, offsets, lengths = zip(*INDEX_ENTRY.iter_unpack(index)) if index else ((), (), ())
+            self.first_keys = list(first_keys)
+            self.offsets = array('Q', offsets)
+            self.lengths = array('I', lengths)
+            self.loaded = True
+
+    def has_stored_filter(self) -> bool:
+        bf = self.meta.get('bloom_filter')
+        return bool(bf) and bf.get('hash') == HASH_SCHEME
+
+    def filter_missing(self) -> bool:
+        return self.meta['count'] > 0 and self.bloom_filter is None and not self.has_stored_filter()
+
+    def iter_keys(self) -> Iterator[bytes]:
+        self.load()
+        for block in range(len(self.offsets)):
+            buffer, pos, end = self.block_data(block)
+            while pos < end:
+                key, pos = skip_record(buffer, pos)
+                yield key
+
+    def rebuild_filter(self, false_positive_prob: float = 0.01) -> None:
+        # kept in memory only, the segment file itself is never rewritten
+        self.load()
+        bloom_filter = BloomFilter(self.meta['count'], false_positive_prob)
+        bloom_filter.add_many(list(self.iter_keys()))
+        self.bloom_filter = bloom_filter
+
+    def close(self) -> None:
+        self.data.close()
+
+    def block_data(self, block: int) -> Tuple[bytes, int, int]:
+        # the buffer holding the records of a block and where they start and end in it
+        pos = self.offsets[block]
+        end = pos + self.lengths[block]
+        if self.codec.name == 'none':
+            return self.data, pos, end
+        raw = self.codec.decompress(self.data[pos:end])
+        return raw, 0, len(raw)
+
+    def decode_block(self, block: int) -> Tuple[List[bytes], List[Value]]:
+        keys: List[bytes] = []
+        values: List[Value] = []
+        buffer, pos, end = self.block_data(block)
+        while pos < end:
+            key, value, pos = decode_record(buffer, pos)
+            keys.append(key)
+            values.append(value)
+        return keys, values
+
+    def cached_block(self, block: int) -> Tuple[List[bytes], List[Value]]:
+        cache_key = (self.path, self.offsets[block])
+        decoded = self.cache.get(cache_key)
+        if decoded is None:
+            decoded = self.decode_block(block)
+            self.bytes_read += self.lengths[block]
+            raw_length = int(self.lengths[block] * self.compression_ratio)
+            self.cache.put(cache_key, decoded, raw_length + DECODED_RECORD_OVERHEAD * len(decoded[0]))
+        return decoded
+
+    def search_block(self, block: int, key: bytes) -> Optional[Value]:
+        if self.cache is not None:
+            keys, values = self.cached_block(block)
+            position = bisect_right(keys, key) - 1
+            return values[position] if position >= 0 and keys[position] == key else None
+
+        # records are walked in place on the mapping, only the match gets decoded
+        self.bytes_read += self.lengths[block]
+        buffer, pos, end = self.block_data(block)
+        while pos < end:
+            r_key, next_pos = skip_record(buffer, pos)
+            if r_key == key:
+                return decode_record(buffer, pos)[1]
+            if r_key > key:
+                return None
+            pos = next_pos
+        return None
+
+    def might_contain(self, key: bytes) -> bool:
+        if self.min_key is None or not self.min_key <= key <= self.max_key:
+            return False
+        self.load()
+        if self.bloom_filter is None or self.bloom_filter.check(key):
+            return True
+        self.filter_negatives += 1
+        return False
+
+    def get(self, key: bytes) -> Optional[Value]:
+        if not self.might_contain(key):
+            return None
+        block = bisect_right(self.first_keys, key) - 1
+        if block < 0:
+            return None
+        return self.search_block(block, key)
+
+    def __iter__(self) -> Iterator[Tuple[bytes, Value]]:
+        return self.scan()
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, Value]:
+        # keys must be sorted, filters are probed in bulk and every block is read at most once
+        if self.min_key is None:
+            return {}
+        keys = keys[bisect_left(keys, self.min_key):bisect_right(keys, self.max_key)]
+        if not keys:
+            return {}
+        self.load()
+        if self.bloom_filter is not None:
+            probed = len(keys)
+            if probed > BULK_FILTER_MIN_KEYS:
+                keys = [key for key, maybe in zip(keys, self.bloom_filter.check_many(keys)) if maybe]
+            else:
+                keys = [key for key in keys if self.bloom_filter.check(key)]
+            self.filter_negatives += probed - len(keys)
+
+        found: Dict[bytes, Value] = {}
+        position = 0
+        while position < len(keys):
+            block = bisect_right(self.first_keys, keys[position]) - 1
+            block_end = bisect_left(keys, self.first_keys[block + 1]) if block + 1 < len(self.first_keys) else len(keys)
+            found.update(self.search_block_many(block, keys[position:block_end]))
+            position = block_end
+        return found
+
+    def search_block_many(self, block: int, keys: Sequence[bytes]) -> Dict[bytes, Value]:
+        found: Dict[bytes, Value] = {}
+        if self.cache is not None:
+            block_keys, block_values = self.cached_block(block)
+            for key in keys:
+                index = bisect_left(block_keys, key)
+                if index < len(block_keys) and block_keys[index] == key:
+                    found[key] = block_values[index]
+            return found
+
+        # a single pass over the block, advancing through the sorted keys alongside it
+        self.bytes_read += self.lengths[block]
+        buffer, pos, end = self.block_data(block)
+        wanted = 0
+        while pos < end and wanted < len(keys):
+            r_key, next_pos = skip_record(buffer, pos)
+            while wanted < len(keys) and keys[wanted] < r_key:
+                wanted += 1
+            if wanted < len(keys) and keys[wanted] == r_key:
+                found[r_key] = decode_record(buffer, pos)[1]
+                wanted += 1
+            pos = next_pos
+        return found
+
+    def scan(self, start: Optional[bytes] = None, end: Optional[bytes] = None) -> Iterator[Tuple[bytes, Value]]:
+        # keys in [start, end), blocks are decoded one at a time as the scan moves forward
+        if self.min_key is None or (start is not None and start > self.max_key) or (end is not None and end <= self.min_key):
+            return
+        self.load()
+        first = max(bisect_right(self.first_keys, start) - 1, 0) if start is not None else 0
+        for block in range(first, len(self.offsets)):
+            buffer, pos, block_end = self.block_data(block)
+            while pos < block_end:
+                key, next_pos = skip_record(buffer, pos)
+                if end is not None and key >= end:
+                    return
+                if start is None or key >= start:
+                    yield decode_record(buffer, pos)[:2]
+                pos = next_pos
+
+
+class TextSegmentReader(object):
+    '''Reader for the legacy `hex(key), json(value)` segments.'''
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.data: Optional[mmap.mmap] = map_file(path)
+        # the key range comes from the first and last lines, the filter has to be rebuilt from every key
+        self.min_key: Optional[bytes] = None
+        self.max_key: Optional[bytes] = None
+        self.bloom_filter: Optional[BloomFilter] = None
+        self.bytes_read: int = 0
+        self.filter_negatives: int = 0
+        if self.data is not None:
+            self.min_key = self.key_at(0)
+            self.max_key = self.key_at(self.data.rfind(b'\n', 0, self.last_line_end()) + 1)
+
+    def last_line_end(self) -> int:
+        end = len(self.data)
+        while end > 0 and self.data[end - 1:end] == b'\n':
+            end -= 1
+        return end
+
+    def key_at(self, pos: int) -> bytes:
+        return bytes.fromhex(self.data[pos:self.data.find(b',', pos)].decode())
+
+    def filter_missing(self) -> bool:
+        return self.data is not None and self.bloom_filter is None
+
+    def iter_keys(self) -> Iterator[bytes]:
+        pos = 0
+        end = self.last_line_end()
+        while pos < end:
+            yield self.key_at(pos)
+            line_end = self.data.find(b'\n', pos)
+            pos = end if line_end < 0 else line_end + 1
+
+    def rebuild_filter(self, false_positive_prob: float = 0.01) -> None:
+        keys = list(self.iter_keys())
+        bloom_filter = BloomFilter(len(keys), false_positive_prob)
+        bloom_filter.add_many(keys)
+        self.bloom_filter = bloom_filter
+
+    def close(self) -> None:
+        if self.data is not None:
+            self.data.close()
+
+    @staticmethod
+    def parse_line(line: str) -> Tuple[bytes, Value]:
+        key, value = line.strip().split(',', 1)
+        return bytes.fromhex(key), Record.from_json(json.loads(value))
+
+    def get(self, key: bytes) -> Optional[Value]:
+        if not self.might_contain(key):
+            return None
+        # binary search over byte offsets, snapping every probe to the start of its line
+        low, high = 0, len(self.data)
+        while low < high:
+            start = self.data.rfind(b'\n', low, (low + high) // 2) + 1 or low
+            comma = self.data.find(b',', start)
+            end = self.data.find(b'\n', start)
+            end = len(self.data) if end < 0 else end
+            k = bytes.fromhex(self.data[start:comma].decode())
+            self.bytes_read += end - start
+            if k == key:
+                return self.parse_line(self.data[start:end].decode())[1]
+            if key < k:
+                high = start
+            else:
+                low = end + 1
+        return None
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, Value]:
+        found: Dict[bytes, Value] = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def might_contain(self, key: bytes) -> bool:
+        if self.data is None or not self.min_key <= key <= self.max_key:
+            return False
+        if self.bloom_filter is None or self.bloom_filter.check(key):
+            return True
+        self.filter_negatives += 1
+        return False
+
+    def __iter__(self) -> Iterator[Tuple[bytes, Value]]:
+        return self.scan()
+
+    def lower_bound(self, key: bytes) -> int:
+        # offset of the first line whose key is not lower than `key`
+        low, high = 0, len(self.data)
+        while low < high:
+            start = self.data.rfind(b'\n', low, (low + high) // 2) + 1 or low
+            comma = self.data.find(b',', start)
+            end = self.data.find(b'\n', start)
+            end = len(self.data) if end < 0 else end
+            if bytes.fromhex(self.data[start:comma].decode()) < key:
+                low = end + 1
+            else:
+                high = start
+        return low
+
+    def scan(self, start: Optional[bytes] = None, end: Optional[bytes] = None) -> Iterator[Tuple[bytes, Value]]:
+        if self.data is None:
+            return
+        pos = self.lower_bound(start) if start is not None else 0
+        while pos < len(self.data):
+            line_end = self.data.find(b'\n', pos)
+            line_end = len(self.data) if line_end < 0 else line_end
+            key, value = self.parse_line(self.data[pos:line_end].decode())
+            if end is not None and key >= end:
+                return
+            yield key, value
+            pos = line_end + 1
+
+
+def is_sstable(path: str) -> bool:
+    with open(path, 'rb') as file:
+        file.seek(0, 2)
+        if file.tell() < TRAILER.size:
+            return False
+        file.seek(-len(MAGIC), 2)
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def open_segment(path: str, cache: Optional[BlockCache] = None) -> SSTableReader | TextSegmentReader:
+    if Path(path).exists() and is_sstable(path):
+        return SSTableReader(path, cache)
+    return TextSegmentReader(path)
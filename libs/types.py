@@ -1,4 +1,22 @@
-from typing import Dict
+from typing import Any, Dict, NamedTuple
 
 
-Value = Dict[str, bytes | str]
\ No newline at end of file
+class Record(NamedTuple):
+    '''The value stored under a key. Immutable, so the memtable, the caches and every reader share one instance.'''
+
+    content_type: str
+    encoding: str
+    value: bytes  # a BlobRef once the value lives in the blob log
+
+    def to_json(self) -> Dict[str, str]:
+        return {'content_type': self.content_type, 'encoding': self.encoding, 'value': self.value.hex()}
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'Record':
+        return cls(data.get('content_type', ''), data.get('encoding', ''), bytes.fromhex(data['value']))
+
+
+Value = Record
+
+# stands in for the value of a deleted key until a compaction reaching the oldest segment drops it
+TOMBSTONE: Value = Record('', '', b'')
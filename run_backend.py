@@ -1,7 +1,7 @@
 import os
 import requests
 from backend.http_handler import HTTPHandler
-from http.server import HTTPServer
+from libs.http_server import BoundedThreadingHTTPServer
 import argparse
 
 
@@ -9,6 +9,7 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Backend for  the YADDB database!')
     parser.add_argument('-H', '--host', help='IP in the machine that will serve', default='0.0.0.0')
     parser.add_argument('-p', '--port', help='Port in which the app will run', default='19090')
+    parser.add_argument('-w', '--workers', help='Requests handled concurrently, idle connections do not count', type=int, default=16)
     subparsers = parser.add_subparsers(dest='mode')
     subparsers.required = True
     mode_parser = subparsers.add_parser('slave')
@@ -41,7 +42,7 @@ if __name__ == '__main__':
     else:
         os.environ['DB_NODE_MODE'] = args.mode
         host, port = args.host, args.port
-    server = HTTPServer((host, int(port)), HTTPHandler)
+    server = BoundedThreadingHTTPServer((host, int(port)), HTTPHandler, args.workers)
 
     print('Running server!')
 
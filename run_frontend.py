@@ -1,8 +1,9 @@
-from math import ceil
-import os
 import requests
+from frontend.async_router import run_async_frontend
+from frontend.pool import BackendPool
 from frontend.router import makeHTTPHandler
-from http.server import HTTPServer
+from frontend.routing import RoutingTable
+from libs.http_server import BoundedThreadingHTTPServer
 import argparse
 
 
@@ -14,13 +15,26 @@ def parse_args():
         '-p', '--port', help='Port in which the app will run', default='19090')
     parser.add_argument(
         '--nodes', nargs='+', help='IPs and ports of the machines that will run the distributed server. (0.0.0.0:19090)', required=True)
+    parser.add_argument(
+        '--vnodes', help='Virtual nodes per node on the consistent hash ring, 0 splits the keys in one range per node', type=int, default=256)
+    parser.add_argument(
+        '--weights', nargs='+', help='Relative capacity of every node, in the order of --nodes (1 each by default)', type=int)
+    parser.add_argument(
+        '-w', '--workers', help='Requests handled concurrently, idle connections do not count', type=int, default=32)
+    parser.add_argument(
+        '--pool-size', help='Most connections kept open to every node', type=int, default=8)
+    parser.add_argument(
+        '--timeout', help='Seconds to wait for a node to connect, answer or free a connection', type=float, default=5.0)
+    parser.add_argument(
+        '--async', dest='use_async', help='Serve every client from a single asyncio event loop instead of a thread pool', action='store_true')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
 
-    dht_lookup = {}
+    if args.weights and len(args.weights) != len(args.nodes):
+        raise Exception('There must be one weight per node!')
 
     with requests.Session() as r:
         for node in args.nodes:
@@ -34,46 +48,33 @@ if __name__ == '__main__':
             if res.ok:
                 print(f'Node {node} is alive!')
         
-        size = 2 ** 128 - 1  # space of hash keys
-
-        per_node = size // len(args.nodes)
-
-        last_end = -1
-
-        o = size % len(args.nodes)
-
-        iterator = enumerate(args.nodes)
-
-        while last_end < size:
-            id, node = next(iterator)
-            start = last_end + 1
-            if o > 0:
-                o -= 1
-                end = start + per_node + ( 1 if last_end < 0 else 0)
-            else:
-                end = start + per_node + ( 0 if last_end < 0 else -1)
-            last_end = end
-
-            start = start.to_bytes(16, byteorder='little', signed=False).hex()
-            end = end.to_bytes(16, byteorder='little', signed=False).hex()
+        if args.vnodes > 0:
+            routing = RoutingTable.ring(args.nodes, args.vnodes, args.weights)
+        else:
+            routing = RoutingTable.even(args.nodes, args.weights)
+        shares = routing.shares()
 
+        for id, (node, ranges) in enumerate(routing.ranges().items()):
             res = r.post(f'http://{node}/join', json={
                 "id": str(id),
-                "start": start,
-                "end": end
+                "ranges": [[start.hex(), end.hex()] for start, end in ranges]
             })
 
             if res.ok:
-                print(f'Node {node} joined the cluster with start={start} and end={end}')
+                print(f'Node {node} joined the cluster with {len(ranges)} key ranges, {shares[node]:.1%} of the keys')
             else:
                 print(f'Node {node} did not join! message="{res.text}"')
                 print('Aborting')
                 exit(1)
-            
-            dht_lookup[(bytes.fromhex(start), bytes.fromhex(end))] = node
 
-    server = HTTPServer((args.host, int(args.port)), makeHTTPHandler(dht_lookup))
+    if args.use_async:
+        print('Running asyncio server!')
+
+        run_async_frontend(args.host, int(args.port), routing, max_size=args.pool_size, timeout=args.timeout)
+    else:
+        pool = BackendPool(max_size=args.pool_size, timeout=args.timeout)
+        server = BoundedThreadingHTTPServer((args.host, int(args.port)), makeHTTPHandler(routing, pool, args.workers), args.workers)
 
-    print('Running server!')
+        print('Running server!')
 
-    server.serve_forever()
+        server.serve_forever()
@@ -0,0 +1,80 @@
+import random
+import tempfile
+import threading
+import time
+
+import pytest
+
+from libs.compaction import POLICIES
+from libs.lsm_tree import LSMTree
+from libs.types import Record
+
+
+KEYS = [i.to_bytes(16, 'big') for i in range(200)]
+
+
+def value_of(key: bytes, version: int) -> bytes:
+    return b'%d:%d:' % (int.from_bytes(key, 'big'), version) * 20
+
+
+def check(key: bytes, record) -> None:
+    assert record is not None
+    assert record.value.startswith(b'%d:' % int.from_bytes(key, 'big'))
+
+
+@pytest.mark.parametrize('policy', ['size_tiered', 'leveled'])
+def test_reads_survive_blob_collection(policy):
+    # blob files are collected by compactions while readers still hold references from older segments
+    tree = LSMTree(
+        'segment-1', tempfile.mkdtemp(), 'wal',
+        threshold=16 * 1024,
+        blob_threshold=64,
+        blob_file_bytes=32 * 1024,
+        wal_durability='none',
+        compaction_policy=POLICIES[policy]()
+    )
+    for key in KEYS:
+        tree.db_set(key, Record('', '', value_of(key, 0)))
+
+    errors = []
+    stop = threading.Event()
+
+    def writer(seed: int) -> None:
+        rng = random.Random(seed)
+        version = 0
+        try:
+            while not stop.is_set():
+                version += 1
+                key = rng.choice(KEYS)
+                tree.db_set(key, Record('', '', value_of(key, version)))
+        except Exception as e:
+            errors.append(e)
+
+    def reader(seed: int) -> None:
+        rng = random.Random(seed)
+        try:
+            while not stop.is_set():
+                key = rng.choice(KEYS)
+                check(key, tree.db_get(key))
+                keys = rng.sample(KEYS, 20)
+                found = tree.multi_get(keys)
+                assert len(found) == len(keys)
+                for key in keys:
+                    check(key, found[key])
+                for key, record in tree.scan(rng.choice(KEYS), None, 50):
+                    check(key, record)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(6)]
+    threads += [threading.Thread(target=reader, args=(seed,)) for seed in range(6, 8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(4)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    tree.close()
+
+    assert not errors, errors[:3]
+    assert 1 not in tree.blob_log.file_numbers(), 'no blob file was collected'
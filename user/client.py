@@ -25,6 +25,17 @@ class YADDBClient:
         else:
             return None
 
+    def read_many(self, keys):
+        hash_keys = {mmh3.hash_bytes(key).hex(): key for key in keys}
+        res = requests.post(f'http://{self.host}:{self.port}/mquery', json=list(hash_keys))
+        if not res.ok:
+            return None
+        response = {}
+        for hash_key, value in res.json().items():
+            value['value'] = bytes.fromhex(value['value'])
+            response[hash_keys[hash_key]] = value
+        return response
+
     def write(self, key, value,content_type,encoding):
         hash_key = mmh3.hash_bytes(key)
 
@@ -41,5 +52,13 @@ class YADDBClient:
         else:
             return None
 
+    def delete(self, key):
+        hash_key = mmh3.hash_bytes(key)
+        res = requests.put(f'http://{self.host}:{self.port}/delete', json={"key": hash_key.hex()})
+        if res.ok:
+            return res.text
+        else:
+            return None
+
     
     